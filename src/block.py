@@ -1,6 +1,18 @@
-import json
 import time
-from Crypto.Hash import SHA256
+import struct
+import hashlib
+from copy import deepcopy
+
+from merkle import MerkleTree
+
+# Binary header of a Block: timestamp, previous hash and Merkle root of the
+# transactions, followed by the nonce, 80 bytes in total
+HEADER_PREFIX = struct.Struct('>d32s32s')
+NONCE = struct.Struct('>Q')
+
+# Number of latest blocks that are all included in a locator, before its
+# steps start doubling
+LOCATOR_DENSE = 10
 
 class Block:
     """
@@ -8,12 +20,24 @@ class Block:
 
     index: index of the Block
     timestamp: timestamp of the Block's creation
-    transactions: list of the Block's transactions
+    transactions: list of the Block's transactions, or None if it is pruned
     nonce: proof-of-work
     previous_hash: hash of the previous Block
     hash: hash of the Block
+    merkle: cached Merkle tree of the transactions, kept once the Block is
+    sealed until it is pruned, so that inclusion proofs don't rebuild it,
+    never sent to other nodes
+    merkle_root: root of the Merkle tree of the transactions, kept once the
+    Block is sealed, so that its hash can be validated even if it is pruned,
+    a received Block only computes it when it is first needed
+    sealed: whether the Block is mined and can't be modified anymore, so that
+    it is shared by reference between the miner, the chain and the store
     """
 
+    # A long running node keeps every block, so they have no __dict__
+    __slots__ = ('index', 'timestamp', 'transactions', 'nonce', 'previous_hash', 'hash', 'merkle',
+                 'merkle_root', 'sealed')
+
     def __init__(self, index, previous_hash):
         """Initializes a Block"""
 
@@ -23,11 +47,96 @@ class Block:
         self.nonce = None
         self.previous_hash = previous_hash
         self.hash = None
+        self.merkle = None
+        self.merkle_root = None
+        self.sealed = False
+
+    @classmethod
+    def received(cls, index, timestamp, nonce, previous_hash, hash, transactions, merkle_root=None):
+        """Creates a sealed Block from the fields of a received one, with its
+        sealed transactions, or with the root of their Merkle tree if it is
+        pruned, without the checks of __setattr__ and without building the
+        Merkle tree, until it is needed"""
+
+        block = object.__new__(cls)
+        block.__setstate__({
+            'index': index,
+            'timestamp': timestamp,
+            'transactions': None if transactions is None else tuple(transactions),
+            'nonce': nonce,
+            'previous_hash': previous_hash,
+            'hash': hash,
+            'merkle': None,
+            'merkle_root': merkle_root,
+            'sealed': True
+        })
+        return block
+
+    def __setattr__(self, name, value):
+        """Rejects any change to a sealed Block"""
+
+        if getattr(self, 'sealed', False):
+            raise AttributeError("sealed block can't be modified")
+        object.__setattr__(self, name, value)
+
+    def __copy__(self):
+        """A sealed Block is immutable, so it's its own copy"""
+
+        if self.sealed:
+            return self
+        replica = object.__new__(Block)
+        replica.__setstate__(self.__getstate__())
+        return replica
+
+    def __deepcopy__(self, memo):
+        """A sealed Block is immutable, so it's its own copy"""
+
+        if self.sealed:
+            return self
+        replica = object.__new__(Block)
+        replica.__setstate__(deepcopy(self.__getstate__(), memo))
+        return replica
+
+    def seal(self):
+        """Freezes the Block and its transactions, after it has been mined or
+        received, keeping their Merkle tree and its root"""
+
+        if self.transactions is not None:
+            for transaction in self.transactions:
+                if not transaction.sealed:
+                    transaction.seal()
+            self.transactions = tuple(self.transactions)
+            self.merkle = self.merkle_tree()
+            self.merkle_root = self.merkle.root
+        self.sealed = True
+        return self
+
+    def prune(self):
+        """Drops the transactions of a sealed Block and their Merkle tree,
+        which keeps its header, the only change that a sealed Block allows"""
+
+        self.root()
+        object.__setattr__(self, 'transactions', None)
+        object.__setattr__(self, 'merkle', None)
+
+    def __getstate__(self):
+        """Excludes the cached Merkle tree when pickling a Block, so that the
+        tree is always computed from the received transactions"""
+
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state['merkle'] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restores the fields of an unpickled Block, even if it is sealed"""
+
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
 
     def __str__(self):
         """String representation of a Block"""
 
-        return str(self.__class__) + ": " + str(self.__dict__)
+        return str(self.__class__) + ": " + str({name: getattr(self, name) for name in self.__slots__})
 
     def __eq__(self, block):
         """Overrides the default method and checks the equality of 2 Block
@@ -45,27 +154,218 @@ class Block:
 
         return False
 
+    def merkle_tree(self):
+        """Returns the Merkle tree of the Block's transactions, which is only
+        rebuilt when the transactions have changed, and never once the Block
+        is sealed"""
+
+        if self.sealed and self.merkle is not None:
+            return self.merkle
+
+        ids = [transaction.id for transaction in self.transactions]
+        if self.merkle is not None and self.merkle.ids == ids:
+            return self.merkle
+
+        merkle = MerkleTree(ids)
+        object.__setattr__(self, 'merkle', merkle)
+        if self.sealed:
+            object.__setattr__(self, 'merkle_root', merkle.root)
+        return merkle
+
+    def root(self):
+        """Returns the root of the Merkle tree of the Block's transactions"""
+
+        if self.sealed and self.merkle_root is not None:
+            return self.merkle_root
+        return self.merkle_tree().root
+
+    def header_prefix(self):
+        """Returns the fixed part of the Block's header, that precedes the nonce"""
+
+        if isinstance(self.previous_hash, str):
+            previous_hash = bytes.fromhex(self.previous_hash)
+        else:
+            # The genesis block has 1 as its previous hash
+            previous_hash = self.previous_hash.to_bytes(32, 'big')
+
+        return HEADER_PREFIX.pack(self.timestamp, previous_hash, self.root())
+
+    def header(self):
+        """Returns the fields of the Block that its hash covers"""
+
+        return (self.timestamp, self.previous_hash, self.root(), self.nonce)
+
     def hash_block(self):
         """Calculates the hash of the Block"""
 
         # We should compute current hash without using the
         # field self.hash.
-        block_list = [self.timestamp, [transaction.id for transaction in self.transactions], self.nonce, self.previous_hash]
+        header = self.header_prefix() + NONCE.pack(self.nonce)
+        return hashlib.sha256(header).hexdigest()
 
-        block_dump = json.dumps(block_list.__str__())
-        return SHA256.new(block_dump.encode("ISO-8859-1")).hexdigest()
+    def work(self, difficulty):
+        """Returns the expected number of hashes needed to mine the Block, or
+        0 if its hash doesn't meet the target of the difficulty"""
+
+        if not isinstance(self.hash, str) or int(self.hash, 16) >= 1 << (256 - 4 * difficulty):
+            return 0
+        return 1 << (4 * difficulty)
 
 class Blockchain:
     """Class for a blockchain
 
-    blocks: list of validated blocks in the chain"""
+    blocks: list of validated blocks in the chain
+    store: block store on disk that mirrors the chain, or None
+    pruned: number of first blocks of the chain that have been pruned, only
+    their headers are kept in memory
+    difficulty: mining difficulty that the work of the blocks is measured by
+    heights: height of every block of the chain, by hash
+    locations: height and position of every transaction of the blocks that
+    aren't pruned, by id
+    works: accumulated work of the blocks up to every height, so that the
+    work of any part of the chain is found without walking it"""
 
-    def __init__(self):
+    def __init__(self, difficulty=0):
         """Initializes a Blockchain"""
         
         self.blocks = []
+        self.store = None
+        self.pruned = 0
+        self.difficulty = difficulty
+        self.heights = {}
+        self.locations = {}
+        self.works = []
 
     def __str__(self):
         """String representation of a Blockchain"""
 
         return str(self.__class__) + ": " + str(self.__dict__)
+
+    def find_transaction(self, transaction_id):
+        """Finds a confirmed transaction of a block that isn't pruned, and
+        returns its block and its position in the block, or None"""
+
+        location = self.locations.get(transaction_id)
+        if location is None:
+            return None
+
+        height, position = location
+        return self.blocks[height], position
+
+    def index(self, block):
+        """Indexes the block at the end of the chain and its transactions, and
+        adds its work to the accumulated work"""
+
+        height = len(self.works)
+        self.heights[block.hash] = height
+        for position, transaction in enumerate(block.transactions or ()):
+            self.locations[transaction.id] = (height, position)
+        previous_work = self.works[-1] if self.works else 0
+        self.works.append(previous_work + block.work(self.difficulty))
+
+    def unindex(self, start):
+        """Removes the blocks from height start on from the indexes"""
+
+        for block in self.blocks[start:]:
+            self.heights.pop(block.hash, None)
+            self.unindex_transactions(block)
+        del self.works[start:]
+
+    def unindex_transactions(self, block):
+        """Removes the transactions of a block from the index"""
+
+        for transaction in block.transactions or ():
+            self.locations.pop(transaction.id, None)
+
+    def load(self, blocks):
+        """Sets the blocks of the chain, when they are read from its store"""
+
+        self.unindex(0)
+        self.blocks = list(blocks)
+        for block in self.blocks:
+            self.index(block)
+
+    def append(self, block):
+        """Adds a block at the end of the chain, and of its store"""
+
+        self.blocks.append(block)
+        self.index(block)
+        if self.store is not None:
+            self.store.append(block)
+
+    def replace(self, start, blocks):
+        """Replaces the blocks of the chain from height start on, and the
+        ones of its store"""
+
+        self.unindex(start)
+        # In place, without copying the blocks before start
+        self.blocks[start:] = blocks
+        for block in blocks:
+            self.index(block)
+        self.pruned = min(self.pruned, start)
+        if self.store is not None:
+            self.store.truncate(start)
+            for block in blocks:
+                self.store.append(block)
+
+    def prune(self, height):
+        """Drops the transactions of the blocks before height from memory,
+        keeping their headers"""
+
+        for block in self.blocks[self.pruned:height]:
+            self.unindex_transactions(block)
+            block.prune()
+        self.pruned = max(self.pruned, height)
+
+    def height(self):
+        """Number of blocks in the chain"""
+
+        return len(self.blocks)
+
+    def tip(self):
+        """Returns the hash of the latest block, or None for an empty chain"""
+
+        return self.blocks[-1].hash if self.blocks else None
+
+    def work(self, start=0):
+        """Returns the accumulated work of the blocks of the chain from
+        height start on"""
+
+        if start >= len(self.works):
+            return 0
+        return self.works[-1] - (self.works[start - 1] if start else 0)
+
+    def height_of(self, block_hash):
+        """Returns the height of a block of the chain, or None if it isn't in
+        the chain"""
+
+        return self.heights.get(block_hash)
+
+    def locator(self):
+        """Returns the hashes of some blocks of the chain, starting from the
+        latest one, with every block near the tip and exponentially fewer
+        towards the genesis block, which is always included"""
+
+        hashes = []
+        step = 1
+        i = len(self.blocks) - 1
+        while i > 0:
+            hashes.append(self.blocks[i].hash)
+            if len(hashes) >= LOCATOR_DENSE:
+                step *= 2
+            i -= step
+
+        if self.blocks:
+            hashes.append(self.blocks[0].hash)
+        return hashes
+
+    def fork_point(self, locator):
+        """Returns the height of the latest block of a locator that is also in
+        the chain, the blocks from that height on are the ones missing from
+        the chain of the locator, or 0 if no block is shared"""
+
+        for block_hash in locator:
+            height = self.heights.get(block_hash)
+            if height is not None:
+                return height + 1
+        return 0
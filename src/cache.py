@@ -0,0 +1,49 @@
+from threading import Lock
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Class for a bounded cache that evicts its least recently used entries
+
+    capacity: max number of entries
+    entries: cached values by key, from the least to the most recently used
+    hits: number of lookups that found their key
+    misses: number of lookups that didn't find their key
+    lock: lock in order to provide mutual exclusion while updating the cache
+    """
+
+    def __init__(self, capacity):
+        """Initializes an LRUCache"""
+
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        """Number of cached entries"""
+
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Returns the value of a key and marks it as recently used"""
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """Adds or updates a key, evicting the least recently used entry if
+        the cache is full"""
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
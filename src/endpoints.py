@@ -1,9 +1,14 @@
 import pickle
+import functools
+import wire
 import node
 
 from flask import Blueprint, jsonify, request
 
-from node import Node, MINING_DIFFICULTY
+from block import NONCE
+from signature import DEFAULT_SCHEME
+from transaction import verified_cache
+from node import Node, MINING_DIFFICULTY, SYNC_RANGE, HEADERS_RANGE
 from node import Node
 
 # Define the node object of the current node and the number of nodes
@@ -14,6 +19,22 @@ n = 0
 rest_api = Blueprint('rest_api', __name__)
 
 
+def chain_waiter(endpoint):
+    '''Answers the requests of an endpoint that waits for the chain lock with
+    a 503, when too many requests already wait for it'''
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        if not node.chain_waiters.acquire(blocking=False):
+            return jsonify({'message': "Too many requests wait for the chain"}), 503
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            node.chain_waiters.release()
+
+    return wrapper
+
+
 @rest_api.route('/register_node', methods=['POST'])
 def register_node():
     '''Registers a new node in the network, called only by the bootstrap node'''
@@ -22,25 +43,32 @@ def register_node():
     node_key = request.form.get('public_key')
     node_ip = request.form.get('ip')
     node_port = request.form.get('port')
+    node_scheme = request.form.get('scheme', DEFAULT_SCHEME)
+
+    # All the nodes must use the signature scheme of the bootstrap node,
+    # which is sent back so that the node can register again with it
+    if node_scheme != node.ring.scheme:
+        return jsonify({'message': 'Unsupported signature scheme', 'scheme': node.ring.scheme}), 409
+
     node_id = len(node.ring)
 
     # Add node in the list of registered nodes
     node.register_node_to_ring(
         id=node_id, ip=node_ip, port=node_port, public_key=node_key, balance=0)
+    node.save_state()
 
     # When all nodes are registered, the bootstrap node sends them 
-    # the chain, the ring and the first transaction
+    # the ring, the chain and the first transaction. The ring goes first, so
+    # that the keys in the chain can be resolved by their fingerprints
     if (node_id == n - 1):
-        for ring_node in node.ring:
-            if ring_node["id"] != node.id:
-                node.share_chain(ring_node)
-                node.share_ring(ring_node)
-        for ring_node in node.ring:
-            if ring_node["id"] != node.id:
-                node.create_transaction(
-                    ring_node['public_key'],
-                    ring_node['id'],
-                    100)
+        for ring_node in node.ring.peers(node.id):
+            node.share_ring(ring_node)
+            node.share_chain(ring_node)
+        for ring_node in node.ring.peers(node.id):
+            node.create_transaction(
+                ring_node['public_key'],
+                ring_node['id'],
+                100)
 
     return jsonify({'id': node_id})
 
@@ -49,7 +77,11 @@ def register_node():
 def validate_transaction():
     '''Validates an incoming transaction'''
 
-    new_transaction = pickle.loads(request.get_data())
+    try:
+        new_transaction = wire.decode_transaction(request.get_data())
+    except ValueError:
+        return jsonify({'message': "Malformed transaction"}), 400
+
     if node.validate_transaction(new_transaction):
         return jsonify({'message': "OK"}), 200
     else:
@@ -60,47 +92,114 @@ def validate_transaction():
 def receive_transaction():
     '''Receives a transaction and add it to a block'''
 
-    new_transaction = pickle.loads(request.get_data())
+    try:
+        new_transaction = wire.decode_transaction(request.get_data())
+    except ValueError:
+        return jsonify({'message': "Malformed transaction"}), 400
+
     node.add_transaction_to_block(new_transaction)
 
     return jsonify({'message': "OK"}), 200
 
 
+@rest_api.route('/validate_transactions', methods=['POST'])
+def validate_transactions():
+    '''Validates a batch of incoming transactions, with a result for each one'''
+
+    try:
+        new_transactions = wire.decode_transactions(request.get_data())
+    except ValueError:
+        return jsonify({'message': "Malformed transactions"}), 400
+
+    results = [node.validate_transaction(transaction) for transaction in new_transactions]
+    return jsonify({'results': results}), 200
+
+
+@rest_api.route('/receive_transactions', methods=['POST'])
+def receive_transactions():
+    '''Receives a batch of transactions and adds them to blocks'''
+
+    try:
+        new_transactions = wire.decode_transactions(request.get_data())
+    except ValueError:
+        return jsonify({'message': "Malformed transactions"}), 400
+
+    for transaction in new_transactions:
+        node.add_transaction_to_block(transaction)
+
+    return jsonify({'results': [True] * len(new_transactions)}), 200
+
+
+@rest_api.route('/submit_transactions', methods=['POST'])
+def submit_transactions():
+    '''Validates a batch of transactions and adds the valid ones to blocks,
+    with a result for each one'''
+
+    try:
+        new_transactions = wire.decode_transactions(request.get_data())
+    except ValueError:
+        return jsonify({'message': "Malformed transactions"}), 400
+
+    results = [node.submit_transaction(transaction) for transaction in new_transactions]
+    return jsonify({'results': results}), 200
+
+
+@rest_api.route('/reject_transactions', methods=['POST'])
+@chain_waiter
+def reject_transactions():
+    '''Rolls back a batch of transactions that another node rejected'''
+
+    try:
+        rejected_transactions = wire.decode_transactions(request.get_data())
+    except ValueError:
+        return jsonify({'message': "Malformed transactions"}), 400
+
+    return jsonify({'results': node.rollback_transactions(rejected_transactions)}), 200
+
+
 @rest_api.route('/receive_block', methods=['POST'])
+@chain_waiter
 def receive_block():
     '''Receives a block, validate it and add it to the blockchain'''
     
-    new_block = pickle.loads(request.get_data())
-    node.chain_lock.acquire()
-    if node.validate_block(new_block):
-        # If the block is valid, add it to the blockchain, remove its
-        # transactions from your unconfirmed_blocks and update previous hash and index 
-        node.stop_mining = True
-        with node.filter_lock:
-            node.chain.blocks.append(new_block)
-            node.chain_lock.release()
-            node.filter_blocks(new_block)
-            node.stop_mining = False
-    else:
-        # If the block is not valid, check either if the signature is not valid or
-        # if you need to resolve conflicts
+    try:
+        new_block = wire.decode_block(request.get_data())
+    except ValueError:
+        return jsonify({'message': "Malformed block"}), 400
+
+    if not node.validate_hash(new_block) or not node.verify_transactions(new_block):
+        return jsonify({'message': "The signature is not valid"}), 401
+
+    with node.chain_lock:
         if node.validate_previous_hash(new_block):
-            node.chain_lock.release()
-            return jsonify({'message': "The signature is not valid"}), 401
-        else:
-            # Resolve conflicts
-            if node.resolve_conflicts(new_block):
-                # Add block to the current blockchain
-                node.stop_mining = True
-                with node.filter_lock:
-                    node.chain.blocks.append(new_block)
-                    node.chain_lock.release()
-                    # Remove the new_block's transactions from your unconfirmed_blocks
-                    node.filter_blocks(new_block)
-                    node.stop_mining = False
-            else:
-                node.chain_lock.release()
-                return jsonify({'mesage': "Block rejected"}), 409
+            # If the block extends the chain, add it to the blockchain together
+            # with the orphan blocks that extend it, and remove their
+            # transactions from your mempool
+            node.add_block(new_block)
+            return jsonify({'message': "OK"})
+
+        # Otherwise keep it in the orphan pool until it can be connected
+        node.orphans.add(new_block)
+        start, blocks = node.branch(new_block)
+        if start is not None:
+            # The block belongs to a fork, which replaces the end of the chain
+            # only if it has more work and doesn't replace pruned history
+            if node.has_more_work(start, blocks) and node.can_replace(start):
+                node.switch_chain(start, blocks)
+                return jsonify({'message': "OK"})
+            return jsonify({'mesage': "Block rejected"}), 409
+
+        if len(blocks) == 1 and new_block.index == node.chain.height() + 1:
+            # The block is ahead by one, its parent is probably on its way,
+            # otherwise it is fetched with a sync after a while
+            node.expect_parent(new_block)
+            return jsonify({'message': "Orphan block"}), 202
+
+        # Resolve conflicts, as a last resort
+        if node.resolve_conflicts(new_block):
+            node.add_block(new_block)
+        elif node.chain.height_of(new_block.hash) is None:
+            return jsonify({'mesage': "Block rejected"}), 409
 
     return jsonify({'message': "OK"})
 
@@ -109,11 +208,16 @@ def receive_block():
 def receive_ring():
     '''Receives the ring from bootstrap'''
     
-    node.ring = pickle.loads(request.get_data())
+    try:
+        node.ring = wire.decode_ring(request.get_data())
+    except ValueError:
+        return jsonify({'message': "Malformed ring"}), 400
+
     # Update the id of the node based on the given ring
-    for ring_node in node.ring:
-        if ring_node['public_key'] == node.wallet.public_key:
-            node.id = ring_node['id']
+    ring_node = node.ring.find_by_key(node.wallet.public_key)
+    if ring_node:
+        node.id = ring_node['id']
+    node.save_state()
     return jsonify({'message': "OK"})
 
 
@@ -121,7 +225,24 @@ def receive_ring():
 def receive_chain():
     '''Receives the blockchain'''
 
-    node.chain = pickle.loads(request.get_data())
+    try:
+        chain = wire.decode_chain(request.get_data())
+    except ValueError:
+        return jsonify({'message': "Malformed chain"}), 400
+
+    if not node.validate_chain(chain.blocks):
+        return jsonify({'message': "The chain is not valid"}), 401
+
+    # The state can't be built from a chain whose transactions were pruned
+    if any(block.transactions is None for block in chain.blocks):
+        return jsonify({'message': "The chain is pruned"}), 409
+    node.chain.replace(0, chain.blocks)
+
+    # Build the utxo set from the transactions of the chain
+    for block in node.chain.blocks:
+        for transaction in block.transactions:
+            node.utxos.add_transaction(transaction)
+        node.utxos.confirm(block.transactions)
     return jsonify({'message': "OK"})
 
 
@@ -129,7 +250,45 @@ def receive_chain():
 def send_chain():
     '''Sends your chain to another node'''
     
-    return pickle.dumps(node.chain)
+    return wire.encode_chain(node.chain)
+
+
+@rest_api.route('/chain_tip', methods=['GET'])
+def chain_tip():
+    '''Advertises the height, the hash of the latest block and the accumulated
+    work of your chain'''
+
+    return jsonify({'height': node.chain.height(), 'hash': node.chain.tip(), 'work': node.chain.work()})
+
+
+@rest_api.route('/chain_headers', methods=['POST'])
+def chain_headers():
+    '''Sends the headers of the blocks of your chain after the latest block of
+    a locator that is also in your chain, up to HEADERS_RANGE headers'''
+
+    locator = request.form.getlist('locator')
+    start = node.chain.fork_point(locator)
+    return wire.encode_headers(start, node.chain.blocks[start:start + HEADERS_RANGE])
+
+
+@rest_api.route('/chain_blocks', methods=['POST'])
+def chain_blocks():
+    '''Sends the blocks of your chain after the latest block of a locator that
+    is also in your chain, up to SYNC_RANGE blocks'''
+
+    locator = request.form.getlist('locator')
+    start = node.chain.fork_point(locator)
+    return wire.encode_blocks(start, node.chain.blocks[start:start + SYNC_RANGE])
+
+
+@rest_api.route('/snapshot', methods=['GET'])
+def snapshot():
+    '''Sends the latest snapshot of the state of the ring'''
+
+    snapshot_data = node.snapshot_data
+    if snapshot_data is None:
+        return jsonify({'message': "No snapshot"}), 404
+    return snapshot_data
 
 
 @rest_api.route('/api/create_transaction', methods=['POST'])
@@ -141,18 +300,17 @@ def create_transaction():
     amount = int(request.form.get('amount'))
 
     # Find the receiver's address
-    receiver_public_key = None
-    for ring_node in node.ring:
-        if (ring_node['id'] == receiver_id):
-            receiver_public_key = ring_node['public_key']
-    if (receiver_public_key and receiver_id != node.id):
-        creation = node.create_transaction(receiver_public_key, receiver_id, amount)
-        if creation["success"]:
-            return jsonify({'message': 'Created the transaction', 'balance': node.wallet.wallet_balance(), "mining_time": creation["mining_time"]}), 200
+    ring_node = node.ring.get(receiver_id)
+    if (ring_node and receiver_id != node.id):
+        transaction_id = node.create_transaction(ring_node['public_key'], receiver_id, amount)
+        if transaction_id is not None:
+            # The id is the one that /api/tx_proof expects
+            return jsonify({'message': 'Created the transaction', 'id': transaction_id,
+                            'balance': node.wallet.wallet_balance()}), 200
         else:
-            return jsonify({'message': 'Not enough coins', 'balance': node.wallet.wallet_balance(), "mining_time": creation["mining_time"]}), 400
+            return jsonify({'message': 'Not enough coins', 'balance': node.wallet.wallet_balance()}), 400
     else:
-        return jsonify({'message': 'Wrong receiver', "mining_time": 0}), 400
+        return jsonify({'message': 'Wrong receiver'}), 400
 
 
 @rest_api.route('/api/get_balance', methods=['GET'])
@@ -169,6 +327,33 @@ def get_transactions():
     return pickle.dumps([tr.convert_to_list() for tr in node.chain.blocks[-1].transactions])
 
 
+@rest_api.route('/api/tx_proof/<tx_id>', methods=['GET'])
+def tx_proof(tx_id):
+    '''Gets the Merkle inclusion proof of a confirmed transaction, given the
+    hex encoding of its id'''
+
+    try:
+        transaction_id = bytes.fromhex(tx_id)
+    except ValueError:
+        return jsonify({'message': 'Invalid transaction id'}), 400
+
+    found = node.chain.find_transaction(transaction_id)
+    if found is None:
+        return jsonify({'message': 'Transaction not found'}), 404
+
+    # The header lets the client check the root against the block hash
+    block, position = found
+    tree = block.merkle_tree()
+    return jsonify({
+        'block_hash': block.hash,
+        'block_index': block.index,
+        'header': (block.header_prefix() + NONCE.pack(block.nonce)).hex(),
+        'merkle_root': tree.root.hex(),
+        'leaf': tree.leaf(position),
+        'position': position,
+        'proof': tree.proof(position)})
+
+
 @rest_api.route('/api/get_id', methods=['GET'])
 def get_id():
     '''Gets id of the node'''
@@ -180,4 +365,19 @@ def get_id():
 def get_metrics():
     '''Gets metrics of the network'''
 
-    return jsonify({'num_blocks': len(node.chain.blocks), 'difficulty': MINING_DIFFICULTY, 'capacity': node.capacity})
+    return jsonify({
+        'num_blocks': len(node.chain.blocks),
+        'difficulty': MINING_DIFFICULTY,
+        'capacity': node.capacity,
+        'hashes_per_second': node.miner.hashes_per_second,
+        'mining': node.mining.metrics(),
+        'verified_cache_hits': verified_cache.hits,
+        'mempool': len(node.mempool),
+        'orphans': len(node.orphans),
+        'orphan_transactions': len(node.orphan_transactions),
+        'skipped_validations': node.skipped_validations,
+        'snapshot': {
+            'height': node.snapshot.height if node.snapshot else 0,
+            'commitment': node.snapshot_commitment()},
+        'pruned': node.chain.pruned,
+        'peers': node.transport.metrics()})
@@ -0,0 +1,128 @@
+import time
+import requests
+
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+
+import wire
+
+# Max number of transactions in a batch
+BATCH_SIZE = 64
+
+# Max milliseconds that a transaction waits for its batch to fill
+BATCH_DELAY = 5
+
+def batch_results(response_future, size):
+    """Returns the per-transaction results of a peer's response to a batch,
+    failing all of them if the peer answered with an error, or None if the
+    peer couldn't be reached or was too busy to serve it"""
+
+    try:
+        response = response_future.result()
+    except requests.RequestException:
+        return None
+    if response.status_code == 503:
+        return None
+
+    try:
+        if response.status_code == 200:
+            results = response.json()['results']
+            if len(results) == size:
+                return results
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    return [False] * size
+
+class Coalescer:
+    """
+    Class that gathers the transactions that are sent to the same endpoint of
+    all the peers into batches
+
+    node: the node that sends the transactions
+    endpoint: batch endpoint of the peers
+    batch_size: a batch is sent when it has that many transactions
+    batch_delay: or when its first transaction has waited that many milliseconds
+    pending: transactions waiting for their batch, with the futures of their results
+    first_time: time when the first pending transaction was added
+    condition: condition in order to wait for a batch to fill
+    """
+
+    def __init__(self, node, endpoint, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY):
+        """Initializes a Coalescer and starts its thread"""
+
+        self.node = node
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.pending = []
+        self.first_time = None
+        self.condition = Condition()
+
+        Thread(target=self.run, daemon=True).start()
+
+    def submit(self, transaction):
+        """Adds a transaction to the next batch and returns the future of its
+        result, which is true only if every peer that could be reached
+        accepted the transaction"""
+
+        future = Future()
+        with self.condition:
+            if not self.pending:
+                self.first_time = time.time()
+            self.pending.append((transaction, future))
+            self.condition.notify()
+        return future
+
+    def run(self):
+        """Sends every batch when it is full or when its delay has passed"""
+
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+
+                deadline = self.first_time + self.batch_delay / 1000
+                while len(self.pending) < self.batch_size and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+
+                batch = self.pending[:self.batch_size]
+                self.pending = self.pending[self.batch_size:]
+                if self.pending:
+                    self.first_time = time.time()
+
+            self.flush(batch)
+
+    def flush(self, batch):
+        """Sends a batch to all the peers, without waiting for the responses,
+        and resolves the futures of its transactions when all have answered,
+        a peer that can't be reached is left out, so that a node that is down
+        doesn't reject every transaction of the ring"""
+
+        futures = [future for _, future in batch]
+        peers = self.node.ring.peers(self.node.id)
+        if not peers:
+            for future in futures:
+                future.set_result(True)
+            return
+
+        data = wire.encode_transactions([transaction for transaction, _ in batch])
+        results = [True] * len(batch)
+        remaining = [len(peers)]
+        lock = Lock()
+
+        def peer_done(response_future):
+            peer_results = batch_results(response_future, len(batch))
+            with lock:
+                if peer_results is not None:
+                    for i, result in enumerate(peer_results):
+                        results[i] = results[i] and bool(result)
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+
+            if finished:
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+
+        for response_future in self.node.transport.broadcast(peers, self.endpoint, data):
+            response_future.add_done_callback(peer_done)
@@ -10,8 +10,11 @@ import endpoints
 from flask_cors import CORS
 from argparse import ArgumentParser
 from flask import Flask
+from werkzeug.serving import WSGIRequestHandler
 
+from server import MAX_REQUESTS, AsyncServer
 from transaction import Transaction
+from signature import DEFAULT_SCHEME, SCHEMES
 from endpoints import node, rest_api
 
 # All nodes know the ip and the port of the bootstrap node
@@ -42,11 +45,22 @@ else:
     hostname = socket.gethostname()
     IPAddr = ip_address()
 
+# Serve HTTP/1.1, so that the peers can keep their connections alive
+WSGIRequestHandler.protocol_version = "HTTP/1.1"
+
 # Register the blueprint with the endpoints
 app = Flask(__name__)
 app.register_blueprint(rest_api)
 CORS(app)
 
+def serve(host, port, args):
+    """Serves the rest api with the asyncio server or the flask one"""
+
+    if args.asyncio:
+        AsyncServer(app, host, port, args.max_requests).serve()
+    else:
+        app.run(host=host, port=port)
+
 if __name__ == '__main__':
     parser = ArgumentParser(description='Rest api of noobcash.')
 
@@ -57,18 +71,79 @@ if __name__ == '__main__':
     required.add_argument('-n', type=int, help='number of nodes in the blockchain', required=True)
     required.add_argument('-c', type=int, help='capacity of a block', required=True)
     optional.add_argument('-b', '--bootstrap', action='store_true', help='set if the current node is the bootstrap')
-    
+    optional.add_argument('-w', type=int, help='number of mining processes, defaults to the number of cores')
+    optional.add_argument('--batch-size', type=int, help='max number of transactions that are gossiped in one request')
+    optional.add_argument('--batch-delay', type=float, help='max milliseconds that a transaction waits to be gossiped in a batch')
+    optional.add_argument('--seal-delay', type=float, help='max milliseconds that a transaction waits for its block to fill, before a partially filled block is mined')
+    optional.add_argument('--adaptive', action='store_true', help='set to choose the capacity of a block from the arrival rate of transactions, up to the given capacity, needs --seal-delay')
+    optional.add_argument('-o', '--optimistic', action='store_true', help='set to validate and add transactions in a single round trip')
+    optional.add_argument('--asyncio', action='store_true', help='set to serve with the asyncio server instead of the flask one')
+    optional.add_argument('--max-requests', type=int, default=MAX_REQUESTS, help='max number of requests that the asyncio server serves at the same time')
+    optional.add_argument('-d', '--data-dir', help='directory of the block store, the node is restored from it when restarted')
+    optional.add_argument('--prune', type=int, metavar='K', help='keep the transactions of only the latest K blocks in memory, and the headers of the rest')
+    optional.add_argument('-s', choices=SCHEMES, default=DEFAULT_SCHEME, help='signature scheme, the one of the bootstrap is used by the whole ring')
+
     args = parser.parse_args()
     port = args.p
     endpoints.n = args.n
     node.capacity = args.c
     is_bootstrap = args.bootstrap
 
-    if (is_bootstrap):
+    # Start the mining processes before serving any requests
+    if args.w:
+        node.miner.workers = args.w
+    if args.seal_delay is not None:
+        node.mining.seal_delay = args.seal_delay
+    elif args.adaptive:
+        parser.error('--adaptive needs --seal-delay')
+    node.mining.adaptive = args.adaptive
+    node.miner.start()
+    node.mining.start()
+
+    # Configure the transaction gossip
+    node.optimistic = args.optimistic
+    for batches in (node.validation_batches, node.delivery_batches,
+                    node.submission_batches, node.rejection_batches):
+        if args.batch_size:
+            batches.batch_size = args.batch_size
+        if args.batch_delay is not None:
+            batches.batch_delay = args.batch_delay
+
+    # Generate the wallet with the selected signature scheme
+    node.set_scheme(args.s)
+
+    # The latest block always keeps its transactions
+    if args.prune is not None:
+        if args.prune < 1:
+            parser.error('--prune must keep at least one block')
+        node.prune_depth = args.prune
+
+    # Open the block store, which restores a restarted node
+    try:
+        restored = args.data_dir is not None and node.open_store(args.data_dir)
+    except ValueError as error:
+        parser.error('can\'t restore the node from %s: %s' % (args.data_dir, error))
+
+    if restored:
+        # Restarted node, fetches the blocks that it missed from its peers
+        def sync_function():
+            time.sleep(2)
+            with node.chain_lock:
+                node.sync()
+            print("Node restored")
+
+        threading.Thread(target=sync_function, args=()).start()
+
+        if is_bootstrap:
+            serve(BOOTSTRAP_IP, BOOTSTRAP_PORT, args)
+        else:
+            serve(IPAddr, port, args)
+    elif (is_bootstrap):
         # Bootstrap node, registers itself, creates the genesis block, the first transaction and adds it in the genesis block
         node.id = 0
         node.register_node_to_ring(
             node.id, BOOTSTRAP_IP, BOOTSTRAP_PORT, node.wallet.public_key, 100 * endpoints.n)
+        node.save_state()
 
         # Create genesis block
         gen_block = node.create_new_block()
@@ -78,13 +153,15 @@ if __name__ == '__main__':
         first_transaction = Transaction("0", '0', node.wallet.public_key, node.id, 100 * endpoints.n, 100 * endpoints.n, None)
         gen_block.transactions.append(first_transaction)
         gen_block.hash = gen_block.hash_block()
-        node.wallet.transactions.append(first_transaction)
+        gen_block.seal()
+        node.wallet.transactions[first_transaction.id] = first_transaction
+        node.utxos.add_transaction(first_transaction)
+        node.utxos.confirm([first_transaction])
 
         # Add genesis block in the blockchain
-        node.chain.blocks.append(gen_block)
-        node.current_block = None
+        node.chain.append(gen_block)
 
-        app.run(host=BOOTSTRAP_IP, port=BOOTSTRAP_PORT)
+        serve(BOOTSTRAP_IP, BOOTSTRAP_PORT, args)
     else:
         # Other nodes, request to be registered on the ring
         register_address = 'http://' + BOOTSTRAP_IP + \
@@ -95,12 +172,22 @@ if __name__ == '__main__':
 
             data = {
                 'public_key': node.wallet.public_key,
-                'ip': IPAddr, 'port': port}
+                'ip': IPAddr, 'port': port,
+                'scheme': node.wallet.scheme}
 
             response = requests.post(
                 register_address,
                 data=data)
 
+            if response.status_code == 409:
+                # Switch to the signature scheme of the bootstrap and register again
+                node.set_scheme(response.json()['scheme'])
+                data['public_key'] = node.wallet.public_key
+                data['scheme'] = node.wallet.scheme
+                response = requests.post(
+                    register_address,
+                    data=data)
+
             if response.status_code == 200:
                 print("Node initialized")
 
@@ -109,4 +196,4 @@ if __name__ == '__main__':
         req = threading.Thread(target=thread_function, args=())
         req.start()
 
-        app.run(host=IPAddr, port=port)
+        serve(IPAddr, port, args)
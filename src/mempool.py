@@ -0,0 +1,127 @@
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+# Weight of the latest interval between two arrivals in the moving average
+# of the intervals
+RATE_SMOOTHING = 0.1
+
+class Mempool:
+    """
+    Class for the transactions of a node that are waiting to be included in
+    a mined block
+
+    transactions: the waiting transactions by id, oldest first
+    arrivals: the time that every waiting transaction arrived, by id, in the
+    order of arrival
+    interval: moving average of the seconds between two arrivals, or None
+    last_arrival: the time that the latest transaction arrived, or None
+    lock: lock in order to provide mutual exclusion while updating the pool
+    """
+
+    def __init__(self):
+        """Initializes a Mempool"""
+
+        self.transactions = OrderedDict()
+        self.arrivals = OrderedDict()
+        self.interval = None
+        self.last_arrival = None
+        self.lock = Lock()
+
+    def __len__(self):
+        """Number of waiting transactions"""
+
+        return len(self.transactions)
+
+    def __contains__(self, transaction_id):
+        """Checks if a transaction is waiting"""
+
+        return transaction_id in self.transactions
+
+    def add(self, transaction):
+        """Adds a transaction after the waiting ones, and updates the arrival
+        rate"""
+
+        now = time.monotonic()
+        with self.lock:
+            self.transactions[transaction.id] = transaction
+            self.arrivals[transaction.id] = now
+
+            if self.last_arrival is not None:
+                interval = now - self.last_arrival
+                if self.interval is None:
+                    self.interval = interval
+                else:
+                    self.interval += RATE_SMOOTHING * (interval - self.interval)
+            self.last_arrival = now
+
+    def restore(self, transactions):
+        """Adds transactions before the waiting ones, in their order, when the
+        block that included them isn't part of the chain anymore, they count
+        as just arrived, so that they wait for seal_delay again instead of
+        being sealed at once"""
+
+        now = time.monotonic()
+        with self.lock:
+            for transaction in reversed(transactions):
+                self.transactions[transaction.id] = transaction
+                self.transactions.move_to_end(transaction.id, last=False)
+                self.arrivals.pop(transaction.id, None)
+                self.arrivals[transaction.id] = now
+
+    def remove(self, transaction_id):
+        """Removes a waiting transaction and returns it, or None"""
+
+        with self.lock:
+            self.arrivals.pop(transaction_id, None)
+            return self.transactions.pop(transaction_id, None)
+
+    def remove_confirmed(self, transactions):
+        """Removes the transactions of a block, in time proportional to the
+        size of the block"""
+
+        with self.lock:
+            for transaction in transactions:
+                self.transactions.pop(transaction.id, None)
+                self.arrivals.pop(transaction.id, None)
+
+    def clear(self):
+        """Removes every waiting transaction, when the state that they were
+        added to is replaced"""
+
+        with self.lock:
+            self.transactions.clear()
+            self.arrivals.clear()
+
+    def take(self, count):
+        """Removes and returns the count oldest waiting transactions, or None
+        if there aren't that many"""
+
+        with self.lock:
+            if len(self.transactions) < count:
+                return None
+            transactions = [self.transactions.popitem(last=False)[1] for _ in range(count)]
+            for transaction in transactions:
+                del self.arrivals[transaction.id]
+            return transactions
+
+    def waited(self):
+        """Returns the seconds that the oldest waiting transaction has waited,
+        or 0 if there are none"""
+
+        with self.lock:
+            if not self.arrivals:
+                return 0
+            return time.monotonic() - next(iter(self.arrivals.values()))
+
+    def arrival_rate(self):
+        """Returns the moving average of the transactions that arrive every
+        second, or None before two of them have arrived, the rate drops while
+        no transactions arrive"""
+
+        with self.lock:
+            if self.interval is None:
+                return None
+            interval = max(self.interval, time.monotonic() - self.last_arrival)
+        return 1 / interval if interval > 0 else None
@@ -0,0 +1,83 @@
+import hashlib
+
+# Prefixes that separate the hashes of the leaves from the hashes of the
+# inner nodes, so that an inner node can't be presented as a leaf
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+# Root of a tree without any leaves
+EMPTY_ROOT = bytes(32)
+
+def hash_leaf(data):
+    """Calculates the hash of a leaf"""
+
+    return hashlib.sha256(LEAF_PREFIX + data).digest()
+
+def hash_node(left, right):
+    """Calculates the hash of an inner node from its two children"""
+
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+def verify_proof(leaf, proof, root):
+    """Verifies an inclusion proof, given as a list of (sibling hash, side)
+    pairs from the leaf up to the root, all the hashes being hex strings"""
+
+    current = bytes.fromhex(leaf)
+    for sibling, side in proof:
+        if side == 'left':
+            current = hash_node(bytes.fromhex(sibling), current)
+        else:
+            current = hash_node(current, bytes.fromhex(sibling))
+
+    return current.hex() == root
+
+class MerkleTree:
+    """
+    Class for a Merkle tree over the transactions of a Block
+
+    ids: ids of the transactions, in the order of the Block
+    levels: hashes of every level of the tree, from the leaves up to the root
+    root: hash of the root of the tree
+    """
+
+    def __init__(self, ids):
+        """Initializes a MerkleTree and computes all of its levels"""
+
+        self.ids = ids
+        sha256 = hashlib.sha256
+        level = [sha256(LEAF_PREFIX + id).digest() for id in ids]
+        self.levels = [level]
+
+        while len(level) > 1:
+            # An odd node at the end of a level is promoted as it is
+            next_level = [hash_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+            if len(level) % 2:
+                next_level.append(level[-1])
+            level = next_level
+            self.levels.append(level)
+
+        self.root = level[0] if level else EMPTY_ROOT
+
+    def __len__(self):
+        """Number of leaves of the tree"""
+
+        return len(self.levels[0])
+
+    def leaf(self, position):
+        """Returns the hash of a leaf as a hex string"""
+
+        return self.levels[0][position].hex()
+
+    def proof(self, position):
+        """Returns the inclusion proof of the leaf at a position, as a list of
+        (sibling hash, side) pairs from the leaf up to the root"""
+
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = position ^ 1
+            if sibling < len(level):
+                side = 'left' if sibling < position else 'right'
+                proof.append((level[sibling].hex(), side))
+            position //= 2
+
+        return proof
@@ -0,0 +1,302 @@
+import os
+import time
+import hashlib
+import multiprocessing
+
+from contextlib import contextmanager
+from threading import Condition, Event, Lock, Thread
+
+from block import NONCE
+
+# Number of nonces that a worker tries before checking if it should stop
+CHECK_INTERVAL = 10000
+
+# Seconds between two checks of the stop condition while waiting the workers
+POLL_INTERVAL = 0.01
+
+# Number of consecutive mined blocks that the peers reject, after which the
+# node waits for the chain tip to change before it mines again
+MAX_REJECTIONS = 3
+
+# Event shared by all the workers of the pool, set when they should stop
+stop_event = None
+
+def init_worker(event):
+    """Stores the shared stop event on a newly started worker"""
+
+    global stop_event
+    stop_event = event
+
+def search_nonce(prefix, difficulty, start, step):
+    """Tries the nonces start, start + step, start + 2 * step, ... after a
+    header prefix until a valid hash is found or the workers are stopped,
+    returns the found nonce (or None) and the number of tries"""
+
+    # A hash with difficulty leading zero hex digits is lower than the target
+    target = 1 << (256 - 4 * difficulty)
+
+    # The prefix is hashed once, each try only hashes the nonce on a copy
+    prefix_state = hashlib.sha256(prefix)
+    pack_nonce = NONCE.pack
+
+    nonce = start
+    tries = 0
+    while not stop_event.is_set():
+        for _ in range(CHECK_INTERVAL):
+            state = prefix_state.copy()
+            state.update(pack_nonce(nonce))
+            tries += 1
+            if int.from_bytes(state.digest(), 'big') < target:
+                # Let the other workers know that the block is mined
+                stop_event.set()
+                return nonce, tries
+            nonce += step
+
+    return None, tries
+
+class Miner:
+    """
+    Class for the parallel proof-of-work miner of a node
+
+    difficulty: number of leading zeros of a valid block hash
+    workers: number of processes that split the nonce space
+    pool: pool of the worker processes
+    stop_event: event that stops all the workers when set
+    hashes_per_second: hash rate of the last mining
+    """
+
+    def __init__(self, difficulty, workers=None):
+        """Initializes a Miner"""
+
+        self.difficulty = difficulty
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.stop_event = None
+        self.hashes_per_second = 0
+
+    def start(self):
+        """Starts the worker processes, should be called before the node
+        starts serving requests"""
+
+        if self.pool is None:
+            self.stop_event = multiprocessing.Event()
+            self.pool = multiprocessing.Pool(
+                self.workers, initializer=init_worker, initargs=(self.stop_event,))
+
+    def mine(self, prefix, should_stop):
+        """Searches for a nonce that gives a valid hash after the header prefix
+        of a block, using all the workers, returns the nonce or None if
+        should_stop() became true"""
+
+        self.start()
+        self.stop_event.clear()
+        start_time = time.time()
+
+        # Worker i tries the nonces i, i + workers, i + 2 * workers, ...
+        results = [
+            self.pool.apply_async(search_nonce, (prefix, self.difficulty, i, self.workers))
+            for i in range(self.workers)]
+
+        for result in results:
+            while not result.ready():
+                if should_stop():
+                    self.stop_event.set()
+                result.wait(POLL_INTERVAL)
+
+        outcomes = [result.get() for result in results]
+        elapsed = time.time() - start_time
+        tries = sum(outcome[1] for outcome in outcomes)
+        if tries and elapsed > 0:
+            self.hashes_per_second = tries / elapsed
+
+        nonces = [outcome[0] for outcome in outcomes if outcome[0] is not None]
+        if should_stop() or not nonces:
+            return None
+
+        return min(nonces)
+
+class MiningService:
+    """
+    Class for the background thread of a node that mines blocks sealed from
+    its mempool, so that no request waits for proof-of-work
+
+    node: the node whose blocks are mined
+    cancel: event that cancels the current mining when the chain tip changes
+    condition: condition in order to wake the thread when a block can be sealed
+    pauses: number of chain updates that wait for the mining to stop
+    seal_delay: max milliseconds that a transaction waits for its block to fill
+    before a partially filled block is sealed, or None to wait for a full one
+    adaptive: flag to choose the capacity of every block from the arrival
+    rate of the transactions, up to the capacity of the node
+    blocks_mined: number of blocks mined by the node
+    partial_blocks: number of mined blocks that were sealed before they filled
+    blocks_rejected: number of mined blocks that every peer rejected
+    rejections: number of consecutive mined blocks that every peer rejected
+    stalled_tip: chain tip on which mining stopped after MAX_REJECTIONS
+    rejected blocks, or None
+    mining_time: total seconds spent on the mined blocks
+    last_mining_time: seconds spent on the last mined block
+    lock: lock in order to provide mutual exclusion while updating the stats
+    """
+
+    def __init__(self, node):
+        """Initializes a MiningService"""
+
+        self.node = node
+        self.cancel = Event()
+        self.condition = Condition()
+        self.pauses = 0
+        self.seal_delay = None
+        self.adaptive = False
+
+        self.blocks_mined = 0
+        self.partial_blocks = 0
+        self.blocks_rejected = 0
+        self.rejections = 0
+        self.stalled_tip = None
+        self.mining_time = 0
+        self.last_mining_time = 0
+        self.lock = Lock()
+
+    def start(self):
+        """Starts the mining thread"""
+
+        Thread(target=self.run, daemon=True).start()
+
+    def submit(self):
+        """Wakes the mining thread when a transaction is added to the mempool"""
+
+        with self.condition:
+            self.condition.notify_all()
+
+    @contextmanager
+    def paused(self):
+        """Cancels the current mining and holds the filter lock of the node,
+        so that the chain tip can change, mining restarts on the new tip
+        when every pause is over"""
+
+        with self.condition:
+            self.pauses += 1
+            self.cancel.set()
+        try:
+            with self.node.filter_lock:
+                yield
+        finally:
+            with self.condition:
+                self.pauses -= 1
+                if self.pauses == 0:
+                    self.cancel.clear()
+                self.condition.notify_all()
+
+    def stalled(self):
+        """Checks if mining stopped after MAX_REJECTIONS consecutive rejected
+        blocks, and the chain tip hasn't changed since"""
+
+        with self.lock:
+            if self.stalled_tip is None:
+                return False
+            if self.node.chain.tip() != self.stalled_tip:
+                self.stalled_tip = None
+                self.rejections = 0
+                return False
+            return True
+
+    def capacity(self):
+        """Returns the capacity of the next block, which is the number of
+        transactions that are expected to arrive in seal_delay if it is
+        adaptive, so that blocks fill in about seal_delay at every load"""
+
+        if not self.adaptive or self.seal_delay is None:
+            return self.node.capacity
+
+        rate = self.node.mempool.arrival_rate()
+        if rate is None:
+            return self.node.capacity
+        return max(1, min(self.node.capacity, int(rate * self.seal_delay / 1000)))
+
+    def block_size(self):
+        """Returns the number of transactions of the next sealed block, or 0
+        if they don't fill a block and the oldest one can still wait, and the
+        capacity of the block"""
+
+        waiting = len(self.node.mempool)
+        capacity = self.capacity()
+        if waiting >= capacity:
+            return capacity, capacity
+        if waiting and self.seal_delay is not None and self.node.mempool.waited() >= self.seal_delay / 1000:
+            return waiting, capacity
+        return 0, capacity
+
+    def timeout(self):
+        """Returns the seconds until the oldest waiting transaction has waited
+        for seal_delay, or None to wait for the next one"""
+
+        if self.seal_delay is None or not len(self.node.mempool):
+            return None
+        return max(self.seal_delay / 1000 - self.node.mempool.waited(), 0)
+
+    def run(self):
+        """Mines blocks sealed from the mempool while it fills a block, or
+        while its oldest transaction has waited for seal_delay, then waits for
+        more transactions"""
+
+        node = self.node
+        while True:
+            with self.condition:
+                while True:
+                    if self.pauses or self.stalled():
+                        self.condition.wait()
+                        continue
+                    count, capacity = self.block_size()
+                    if count:
+                        break
+                    self.condition.wait(self.timeout())
+
+            with node.filter_lock:
+                if self.cancel.is_set():
+                    continue
+
+                mined_block = node.seal_block(count)
+                if mined_block is None:
+                    continue
+
+                start_time = time.time()
+                if not node.mine_block(mined_block, self.cancel.is_set):
+                    # The chain tip changed, a new block is sealed on the new one
+                    node.mempool.restore(mined_block.transactions)
+                    continue
+                elapsed = time.time() - start_time
+
+            with self.lock:
+                self.blocks_mined += 1
+                if count < capacity:
+                    self.partial_blocks += 1
+                self.mining_time += elapsed
+                self.last_mining_time = elapsed
+
+            rejected = node.broadcast_block(mined_block)
+            with self.lock:
+                if not rejected:
+                    self.rejections = 0
+                    continue
+                self.blocks_rejected += 1
+                self.rejections += 1
+                if self.rejections >= MAX_REJECTIONS:
+                    # The peers keep rejecting the blocks of the node, which
+                    # waits for a block of theirs instead of mining again
+                    self.stalled_tip = node.chain.tip()
+
+    def metrics(self):
+        """Returns the number of mined blocks, the time spent on them and the
+        current capacity of a block"""
+
+        with self.lock:
+            return {
+                'blocks_mined': self.blocks_mined,
+                'partial_blocks': self.partial_blocks,
+                'blocks_rejected': self.blocks_rejected,
+                'mining_time': self.mining_time,
+                'last_mining_time': self.last_mining_time,
+                'capacity': self.capacity(),
+                'seal_delay': self.seal_delay
+            }
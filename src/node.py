@@ -1,18 +1,53 @@
+import hashlib
 import requests
-import pickle
-import itertools
-import time
-
-from copy import deepcopy
-from collections import deque
-from threading import Lock, Thread
 
+from threading import BoundedSemaphore, Lock, RLock, Timer
+
+import wire
+import store
+import signature
+
+from cache import LRUCache
+from miner import Miner, MiningService
+from gossip import Coalescer
+from transport import Transport, status_codes
+from ring import Ring
+from orphans import OrphanPool, OrphanTransactionPool
+from mempool import Mempool
+from snapshot import Snapshot
+from utxo import UTXOSet
 from wallet import Wallet
 from block import Block, Blockchain
 from transaction import Transaction, TransactionInput
 
 MINING_DIFFICULTY = 4
 
+# Max number of blocks that a peer sends in a single range fetch
+SYNC_RANGE = 500
+
+# Max number of block headers that a peer sends in a single range fetch
+HEADERS_RANGE = 2000
+
+# Seconds that a block that is ahead of the chain by one waits for its
+# parent, before the node fetches the parent with a sync
+ORPHAN_TIMEOUT = 1
+
+# Max number of requests that wait for the chain lock at once, the next ones
+# are answered with a 503, so that they never hold every handler thread of
+# the server while the chain is synced
+MAX_CHAIN_WAITERS = 32
+
+# Max number of headers of validated blocks that are remembered, so that the
+# hashes of the blocks aren't computed again when they are received again
+VALIDATED_CAPACITY = 65536
+
+# A snapshot of the state is taken every that many blocks
+SNAPSHOT_INTERVAL = 100
+
+# Number of blocks after the latest snapshot that are never included in it,
+# so that a fork rarely replaces a block of a snapshot
+SNAPSHOT_DEPTH = 6
+
 class Node:
     """
     Class for a node of the ring
@@ -20,34 +55,71 @@ class Node:
     id: id of the node
     chain: blockchain of the node
     wallet: wallet of the node
-    ring: information about others (id, ip, port, public_key, balance)
+    utxos: set of the unspent transaction outputs of the ring
+    ring: directory with information about others (id, ip, port, public_key, balance, address)
 
     filter_lock: lock in order to provide mutual exclusion while filtering blocks
     chain_lock: lock in order to provide mutual exclusion while updating the chain
-    block_lock: lock in order to provide mutual exclusion while updating blocks
+    transaction_lock: lock in order to provide mutual exclusion while applying
+    or rolling back transactions, taken after the chain and filter locks
+    chain_waiters: semaphore in order to limit the number of requests that
+    wait for the chain lock
     
-    unconfirmed_blocks: queue that contains all the blocks waiting to be mined
-    current_block: the block that the node currently fills with transactions
+    mempool: transactions waiting to be mined, from which blocks are sealed
     capacity: max number of transactions in each block
-    stop_mining: flag to stop mining when a confirmed block arrives
+    orphans: received blocks that don't extend the chain yet
+    orphan_transactions: received transactions that spend outputs that the
+    node hasn't seen yet
+    validated_blocks: headers of the blocks whose hash has been validated, by
+    hash
+    data_dir: directory of the block store and the saved state, or None
+    snapshot: state of the ring after the first blocks of the chain, or None
+    snapshot_data: encoding of the latest snapshot that was taken, or None
+    prune_depth: number of latest blocks whose transactions are kept in
+    memory, or None to keep the transactions of every block
+    skipped_validations: number of blocks whose validation was skipped
+    miner: parallel proof-of-work miner
+    mining: background thread that mines the sealed blocks
+    transport: pooled connections and sender worker of every peer
+    validation_batches: batches of transactions sent to be validated by the peers
+    delivery_batches: batches of validated transactions sent to be added by the peers
+    optimistic: flag to validate and add transactions in a single round trip
+    submission_batches: batches of transactions sent to be validated and added by the peers
+    rejection_batches: batches of rejected transactions sent to be rolled back by the peers
     """
 
     def __init__(self):
         """Initializes a node"""
         
         self.id = None
-        self.chain = Blockchain()
-        self.wallet = Wallet()
-        self.ring = []
+        self.chain = Blockchain(MINING_DIFFICULTY)
+        self.utxos = UTXOSet()
+        self.wallet = Wallet(self.utxos)
+        self.ring = Ring()
 
         self.filter_lock = Lock()
         self.chain_lock = Lock()
-        self.block_lock = Lock()
+        self.transaction_lock = RLock()
+        self.chain_waiters = BoundedSemaphore(MAX_CHAIN_WAITERS)
 
-        self.unconfirmed_blocks = deque()
-        self.current_block = None
+        self.mempool = Mempool()
         self.capacity = None
-        self.stop_mining = False
+        self.orphans = OrphanPool()
+        self.orphan_transactions = OrphanTransactionPool()
+        self.validated_blocks = LRUCache(VALIDATED_CAPACITY)
+        self.skipped_validations = 0
+        self.data_dir = None
+        self.snapshot = None
+        self.snapshot_data = None
+        self.prune_depth = None
+        self.miner = Miner(MINING_DIFFICULTY)
+        self.mining = MiningService(self)
+        self.transport = Transport()
+        self.validation_batches = Coalescer(self, '/validate_transactions')
+        self.delivery_batches = Coalescer(self, '/receive_transactions')
+        self.optimistic = False
+        self.submission_batches = Coalescer(self, '/submit_transactions')
+        self.rejection_batches = Coalescer(self, '/reject_transactions')
 
     def __str__(self):
         """String representation of a node"""
@@ -59,49 +131,178 @@ class Node:
         
         if len(self.chain.blocks) == 0:
             # Genesis block
-            self.current_block = Block(0, 1)
+            return Block(0, 1)
         else:
             # Filled out later
-            self.current_block = Block(None, None)
-        return self.current_block
+            return Block(None, None)
+
+    def seal_block(self, count):
+        """Creates a block with the count oldest transactions of the mempool,
+        taking them out of it, or returns None if there aren't that many"""
+
+        transactions = self.mempool.take(count)
+        if transactions is None:
+            return None
+
+        block = self.create_new_block()
+        block.transactions = transactions
+        return block
+
+    def set_scheme(self, name):
+        """Selects the signature scheme of the ring, generating a new wallet
+        if the current one uses another scheme, called before registration"""
+
+        signature.set_scheme(name)
+        self.ring.scheme = name
+        if self.wallet.scheme != name:
+            self.wallet = Wallet(self.utxos)
+
+    def open_store(self, directory):
+        """Opens the block store and the saved state of the node in a
+        directory, returns True if the node was restored from them, raises a
+        ValueError if the stored chain can't be replayed"""
+
+        self.data_dir = directory
+        self.chain.store = store.BlockStore(directory)
+        state = store.load_state(directory)
+        if state is None or not len(self.chain.store):
+            # Nothing to restore, the node registers from scratch
+            self.chain.store.truncate(0)
+            return False
+
+        self.set_scheme(state['scheme'])
+        self.wallet.private_key = state['private_key']
+        self.wallet.public_key = state['public_key']
+        self.id = state['id']
+        for ring_node in state['ring']:
+            self.ring.register(ring_node['id'], ring_node['ip'], ring_node['port'], ring_node['public_key'], 0)
+
+        # Start from the saved snapshot, if it belongs to the stored chain
+        start = 0
+        snapshot_data = store.load_snapshot(directory)
+        if snapshot_data is not None:
+            try:
+                snapshot = wire.decode_snapshot(snapshot_data)
+            except ValueError:
+                snapshot = None
+            if (snapshot is not None and snapshot.height > 0
+                    and self.chain.store.height_of(snapshot.block_hash) == snapshot.height - 1):
+                self.restore_snapshot(snapshot, snapshot_data)
+                start = snapshot.height
+
+        # Only the headers of the blocks that are pruned anyway are read
+        self.chain.load(self.chain.store.blocks(self.prune_height(len(self.chain.store))))
+        if any(block.transactions is None for block in self.chain.blocks[start:]):
+            raise ValueError('The stored chain is pruned and has no snapshot to start from')
+
+        # Replay the rest of the stored chain, in order to rebuild the utxos
+        # and the balances of the ring
+        for block in self.chain.blocks[start:]:
+            for transaction in block.transactions:
+                self.apply_transaction(transaction)
+            self.utxos.confirm(block.transactions)
+        self.prune_chain()
+        return True
+
+    def restore_snapshot(self, snapshot, snapshot_data):
+        """Sets the utxos and the balances of the ring to the ones of a
+        snapshot"""
+
+        for outpoint, output in snapshot.utxos.outputs.items():
+            self.utxos.add_output(outpoint, output)
+        for public_key, balance in snapshot.balances.items():
+            ring_node = self.ring.find_by_key(public_key)
+            if ring_node:
+                ring_node['balance'] = balance
+
+        self.snapshot = snapshot
+        self.snapshot_data = snapshot_data
+
+    def advance_snapshot(self):
+        """Takes a new snapshot when the chain has grown by SNAPSHOT_INTERVAL
+        blocks after the latest one, advancing the state of the latest one by
+        the new blocks, called while holding the chain lock"""
+
+        # Snapshots are taken at multiples of SNAPSHOT_INTERVAL, so that every
+        # node takes them at the same heights and their commitments match
+        height = (self.chain.height() - SNAPSHOT_DEPTH) // SNAPSHOT_INTERVAL * SNAPSHOT_INTERVAL
+        snapshot = self.snapshot or Snapshot()
+        if height <= snapshot.height:
+            return
+
+        for block in self.chain.blocks[snapshot.height:height]:
+            snapshot.apply(block)
+        self.snapshot = snapshot
+        self.snapshot_data = wire.encode_snapshot(snapshot)
+        if self.data_dir is not None:
+            store.save_snapshot(self.data_dir, self.snapshot_data)
+
+    def prune_chain(self):
+        """Drops the transactions of the blocks before the latest prune_depth
+        ones, if they are included in the latest snapshot"""
+
+        self.prune_blocks(self.prune_height(self.chain.height()))
+
+    def prune_height(self, height):
+        """Returns the height before which the blocks of a chain of a height
+        are pruned, the blocks before the latest prune_depth ones, if they are
+        included in the latest snapshot, since the state can't be rebuilt
+        without them otherwise"""
+
+        if self.prune_depth is None or self.snapshot is None:
+            return 0
+
+        return max(0, min(height - self.prune_depth, self.snapshot.height))
+
+    def prune_blocks(self, height):
+        """Drops the transactions of the blocks before height from memory,
+        together with the ones of the wallet, so that it doesn't grow with
+        the chain either"""
+
+        for block in self.chain.blocks[self.chain.pruned:height]:
+            for transaction in block.transactions or []:
+                self.wallet.transactions.pop(transaction.id, None)
+        self.chain.prune(height)
+
+    def snapshot_commitment(self):
+        """Returns the commitment hash of the latest snapshot, or None"""
+
+        if self.snapshot_data is None:
+            return None
+        return hashlib.sha256(self.snapshot_data).hexdigest()
+
+    def save_state(self):
+        """Saves the id, the keys and the ring of the node, if it has a data
+        directory"""
+
+        if self.data_dir is None:
+            return
+
+        store.save_state(self.data_dir, {
+            'id': self.id,
+            'scheme': self.wallet.scheme,
+            'private_key': self.wallet.private_key,
+            'public_key': self.wallet.public_key,
+            'ring': [{key: ring_node[key] for key in ('id', 'ip', 'port', 'public_key')}
+                     for ring_node in self.ring]
+        })
 
     def register_node_to_ring(self, id, ip, port, public_key, balance):
         """Registers a new node in the ring, called only by the bootstrap node"""
 
-        self.ring.append(
-            {
-                'id': id,
-                'ip': ip,
-                'port': port,
-                'public_key': public_key,
-                'balance': balance
-            })
+        self.ring.register(id, ip, port, public_key, balance)
 
     def create_transaction(self, receiver, receiver_id, amount):
-        """Creates a new transaction, after gathering the inputs from the utxos"""
+        """Creates a new transaction, after gathering the inputs from the utxos,
+        returns the hex encoding of its id, or None if it is rejected"""
 
         # Gather the transaction inputs, using utxos of the node
-        inputs = []
-        inputs_ids = []
-        total = 0
-        for transaction in self.wallet.transactions:
-            for output in transaction.outputs:
-                if (output.target == self.wallet.public_key and output.unspent):
-                    inputs.append(TransactionInput(transaction.id))
-                    inputs_ids.append(transaction.id)
-                    output.unspent = False
-                    total += output.amount
-            if total >= amount:
-                # Stop when the total amount is enough
-                break
-
-        if total < amount:
-            # If there are not enough coins, the utxos are reverted
-            for transaction in self.wallet.transactions:
-                for output in transaction.outputs:
-                    if output.transaction_id in inputs_ids:
-                        output.unspent = True
-            return {"mining_time": 0, "success": False}
+        selected = self.utxos.select(self.wallet.public_key, amount)
+        if selected is None:
+            return None
+
+        inputs = [TransactionInput(*outpoint) for outpoint in selected]
+        total = sum(output.amount for output in selected.values())
 
         transaction = Transaction(
             self.wallet.public_key,
@@ -117,159 +318,224 @@ class Node:
         transaction.sign_transaction(self.wallet.private_key)
 
         # Broadcast transaction 
-        broadcast = self.broadcast_transaction(transaction)
-        mining_time = broadcast["mining_time"]
-        success = broadcast["success"]
-
-        if not success:
-            for transaction in self.wallet.transactions:
-                for output in transaction.outputs:
-                    if output.transaction_id in inputs_ids:
-                        output.unspent = True
-            return {"mining_time": mining_time, "success": False}
+        if not self.broadcast_transaction(transaction):
+            # If the transaction is rejected, the utxos are reverted
+            self.utxos.restore(selected)
+            return None
 
-        return {"mining_time": mining_time, "success": True}
+        return transaction.id.hex()
 
     def add_transaction_to_block(self, transaction):
-        """Adds a transaction to a block, check if mining is needed and update
-        the wallet and balances of participating nodes"""
+        """Adds a transaction to the mempool, wakes the mining thread, which
+        seals a block when the mempool fills one or waits for too long, and
+        updates the wallet and balances of participating nodes"""
 
-        # Add transaction to the wallet of the sender and the receiver
-        if (transaction.sender  == self.wallet.public_key):
-            self.wallet.transactions.append(transaction)
-        if (transaction.receiver == self.wallet.public_key):
-            self.wallet.transactions.append(transaction)
+        with self.transaction_lock:
+            if self.utxos.pending(transaction.id) or transaction.id in self.orphan_transactions:
+                # Delivered twice
+                return
+
+            # The inputs of the node's own transactions are spent when they
+            # are selected
+            if transaction.sender != self.wallet.public_key:
+                missing = self.utxos.missing(transaction)
+                if missing:
+                    # A transaction whose outputs were added was delivered
+                    # after a block that included it, otherwise it spends
+                    # outputs that the node hasn't seen yet and waits for the
+                    # transactions that add them
+                    if not self.utxos.added(transaction):
+                        self.orphan_transactions.add(transaction, missing)
+                    return
+
+            self.apply_transaction(transaction)
+            self.mempool.add(transaction)
+            self.mining.submit()
+            self.connect_orphan_transactions(transaction)
+
+    def connect_orphan_transactions(self, transaction):
+        """Adds the orphan transactions that were waiting only for the outputs
+        of a transaction that was applied, and in turn the ones that wait
+        for theirs"""
+
+        for orphan in self.orphan_transactions.resolve(transaction):
+            self.add_transaction_to_block(orphan)
+
+    def apply_transaction(self, transaction):
+        """Updates the wallet, the utxos and the balances of the participating
+        nodes with a transaction"""
+
+        # Add transaction to the wallet, if the node is its sender or its receiver
+        if self.wallet.public_key in (transaction.sender, transaction.receiver):
+            self.wallet.transactions[transaction.id] = transaction
+
+        # Spend the inputs and add the outputs of the transaction
+        self.utxos.add_transaction(transaction)
 
         # Update the balance of the sender and the receiver
-        for ring_node in self.ring:
-            if ring_node['public_key'] == transaction.sender:
-                ring_node['balance'] -= transaction.amount
-            if ring_node['public_key'] == transaction.receiver:
-                ring_node['balance'] += transaction.amount
-
-        # If chain has only the genesis block, create new block
-        if self.current_block is None:
-            self.current_block = self.create_new_block()
-
-        self.block_lock.acquire()
-        if self.current_block.add_transaction_and_check(transaction, self.capacity):
-            start_time = time.time()
-
-            # Add the block to the mining queue, create a new one, 
-            # mine the first block of the queue and when mining is done
-            # broadcast the mined block
-
-            self.unconfirmed_blocks.append(deepcopy(self.current_block))
-            self.current_block = self.create_new_block()
-            self.block_lock.release()
-            while True:
-                with self.filter_lock:
-                    if (self.unconfirmed_blocks):
-                        mined_block = self.unconfirmed_blocks.popleft()
-                        mining_result = self.mine_block(mined_block)
-                        if (mining_result):
-                            break
-                        else:
-                            self.unconfirmed_blocks.appendleft(mined_block)
-                    else:
-                        return 0
-            mining_time = time.time() - start_time
-            self.broadcast_block(mined_block)
-            return mining_time
-        else:
-            self.block_lock.release()
-            return 0
+        sender = self.ring.find_by_key(transaction.sender)
+        if sender:
+            sender['balance'] -= transaction.amount
+        receiver = self.ring.find_by_key(transaction.receiver)
+        if receiver:
+            receiver['balance'] += transaction.amount
 
     def broadcast_transaction(self, transaction):
-        """Broadcasts a transaction to the network, utilizing threads"""
-
-        def thread_func(node, responses, endpoint):
-            address = 'http://' + node['ip'] + ':' + node['port']
-            response = requests.post(address + endpoint,
-                                        data=pickle.dumps(transaction))
-            responses.append(response.status_code)
-
-        threads = []
-        responses = []
-        for node in self.ring:
-            if node['id'] != self.id:
-                thread = Thread(target=thread_func, args=(
-                    node, responses, '/validate_transaction'))
-                threads.append(thread)
-                thread.start()
-
-        for thread in threads:
-            thread.join()
-
-        for res in responses:
-            if res != 200:
-                return {"mining_time": 0, "success": False}
-        
-        for node in self.ring:
-            if node['id'] != self.id:
-                thread = Thread(target=thread_func, args=(
-                    node, responses, '/receive_transaction'))
-                thread.start()
+        """Broadcasts a transaction to the network, in batches with other
+        transactions"""
+
+        if self.optimistic:
+            # Every peer validates and adds the transaction in a single round
+            # trip, and the peers that accepted a rejected one roll it back.
+            # If a peer has already mined it, it can't be rolled back, so it
+            # is kept like an accepted one and its inputs stay spent
+            if not self.submission_batches.submit(transaction).result():
+                if self.rejection_batches.submit(transaction).result():
+                    return False
+        else:
+            # Every peer validates the transaction
+            if not self.validation_batches.submit(transaction).result():
+                return False
+
+            # The results of the second phase are not awaited
+            self.delivery_batches.submit(transaction)
+
+        self.add_transaction_to_block(transaction)
+        return True
+
+    def submit_transaction(self, transaction):
+        """Validates an incoming transaction and adds it to a block if it is
+        valid, in optimistic mode"""
+
+        if not self.validate_transaction(transaction):
+            return False
+
+        self.add_transaction_to_block(transaction)
+        return True
+
+    def rollback_transactions(self, transactions):
+        """Rolls back a batch of transactions that another node rejected,
+        returns whether each one was rolled back. The current mining is only
+        cancelled if one of them is in the block that is being mined, so
+        that the transactions of that block are back in the mempool"""
+
+        with self.chain_lock:
+            with self.transaction_lock:
+                results = [self.rollback_transaction(transaction, False) for transaction in transactions]
+            if None not in results:
+                return results
+
+            with self.mining.paused(), self.transaction_lock:
+                return [self.rollback_transaction(transaction) if result is None else result
+                        for transaction, result in zip(transactions, results)]
+
+    def rollback_transaction(self, transaction, paused=True):
+        """Removes a rejected transaction from the mempool and reverts the
+        changes of add_transaction_to_block, returns False if the transaction
+        can't be rolled back anymore, because it is in a mined block or
+        another transaction spends its outputs, or None if the mining isn't
+        paused and the transaction is in the block that is being mined,
+        called while holding the transaction lock"""
+
+        if transaction.id not in self.mempool:
+            # Either the transaction was never added, or it is in a mined
+            # block, which is the case if it is pending or has outputs. A
+            # pending one is in the block that is being mined, until that
+            # block is added to the chain
+            if not paused and self.utxos.pending(transaction.id):
+                return None
+            return not self.utxos.pending(transaction.id) and not self.utxos.added(transaction)
+
+        if not self.utxos.unspent(transaction):
+            # A later transaction spends one of its outputs, and would be
+            # left spending outputs that don't exist
+            return False
+
+        removed = self.mempool.remove(transaction.id)
+        if removed is None:
+            # The mining thread sealed it in a block after it was checked
+            return None if not paused else False
 
-        mining_time = self.add_transaction_to_block(transaction)
-        return {"mining_time": mining_time, "success": True}
+        # Revert the wallet, the utxos and the balances
+        self.wallet.transactions.pop(removed.id, None)
+        self.utxos.undo_transaction(removed)
+
+        sender = self.ring.find_by_key(removed.sender)
+        if sender:
+            sender['balance'] += removed.amount
+        receiver = self.ring.find_by_key(removed.receiver)
+        if receiver:
+            receiver['balance'] -= removed.amount
+
+        return True
 
     def validate_transaction(self, transaction):
-        """Validates an incoming transaction, by checking the signature,
-        the inputs and the outputs"""
+        """Validates an incoming transaction, by checking its id, the
+        signature, the inputs and the outputs"""
 
-        if not transaction.verify_signature():
+        # A transaction that has already been added has the same id
+        if self.utxos.pending(transaction.id):
             return False
 
-        for node in self.ring:
-            if node['public_key'] == transaction.sender :
-                if node['balance'] >= transaction.amount:
-                    return True
-        return False
+        if not transaction.matches_content() or not transaction.verify_signature():
+            return False
 
-    def mine_block(self, block):
-        """Implements the proof-of-work algorithm"""
+        # The inputs must be unspent outputs of the sender, including the
+        # outputs of waiting transactions, and add up to the total, so that
+        # neither a double spend nor a forged change output gets through
+        if not 0 < transaction.amount <= transaction.total:
+            return False
+        if self.utxos.input_total(transaction) != transaction.total:
+            return False
+
+        sender = self.ring.find_by_key(transaction.sender)
+        return sender is not None and sender['balance'] >= transaction.amount
+
+    def mine_block(self, block, cancelled):
+        """Implements the proof-of-work algorithm, splitting the nonce space
+        across the processes of the miner, until cancelled() becomes true"""
 
-        block.nonce = 0
         block.index = self.chain.blocks[-1].index + 1
         block.previous_hash = self.chain.blocks[-1].hash
 
-        while (not block.hash_block().startswith('0' * MINING_DIFFICULTY) and not self.stop_mining):
-            block.nonce += 1
+        nonce = self.miner.mine(block.header_prefix(), cancelled)
+        if nonce is None:
+            return False
+
+        block.nonce = nonce
         block.hash = block.hash_block()
+        block.seal()
 
-        return not self.stop_mining
+        return True
 
     def broadcast_block(self, block):
-        """Broadcasts a transaction to the network, utilizing threads"""
-
-        block_accepted = False
-
-        def thread_func(node, responses):
-            address = 'http://' + node['ip'] + ':' + node['port']
-            response = requests.post(address + '/receive_block',
-                                        data=pickle.dumps(block))
-            responses.append(response.status_code)
-
-        threads = []
-        responses = []
-        for node in self.ring:
-            if node['id'] != self.id:
-                thread = Thread(target=thread_func, args=(node, responses))
-                threads.append(thread)
-                thread.start()
+        """Adds a mined block to the chain and broadcasts it to the network,
+        through the workers of the transport, returns whether every peer that
+        answered rejected it"""
+
+        with self.chain_lock:
+            if not self.validate_block(block):
+                # The chain tip changed after the block was mined, so its
+                # transactions are mined again, if no other block has
+                # included them
+                self.mempool.restore([transaction for transaction in block.transactions
+                                      if self.utxos.pending(transaction.id)])
+                return False
 
-        for thread in threads:
-            thread.join()
+            self.add_block(block)
 
-        for response in responses:
-            if response == 200:
-                block_accepted = True
+        data = wire.encode_block(block)
+        futures = self.transport.broadcast(self.ring.peers(self.id), '/receive_block', data)
+        codes = [code for code in status_codes(futures) if code is not None]
+        if not codes or any(code in (200, 202) for code in codes):
+            return False
 
-        if block_accepted:
-            with self.chain_lock:
-                if self.validate_block(block):
-                    self.chain.blocks.append(block)
+        # Every peer that answered is on a fork, which replaces the block if
+        # it has more work, and only the transactions of the block that the
+        # fork didn't include are mined again
+        with self.chain_lock:
+            self.sync()
+        return True
 
     def validate_previous_hash(self, block):
         """Validates the previous hash of an incoming block"""
@@ -279,104 +545,362 @@ class Node:
     def validate_block(self, block):
         """Validates a block, by validating its hash and its previous hash"""
 
-        return self.validate_previous_hash(block) and (block.hash == block.hash_block())
+        return self.validate_previous_hash(block) and self.validate_hash(block)
 
-    def filter_blocks(self, mined_block):
-        """Filters the queue of the unconfirmed blocks, by removing the
-        transactions that are included in a mined block"""
-        
-        with self.block_lock:
-            total_transactions = list(itertools.chain.from_iterable([
-                    unc_block.transactions
-                    for unc_block
-                    in self.unconfirmed_blocks]))
+    def validate_hash(self, block):
+        """Validates the hash of a block, which is computed only if no block
+        with the same hash and header has been validated before"""
 
-            if (self.current_block):
-                total_transactions.extend(self.current_block.transactions)
+        if self.validated_blocks.get(block.hash) == block.header():
+            self.skipped_validations += 1
+            return True
 
-            self.current_block.transactions = []
+        if block.hash != block.hash_block():
+            return False
+        self.validated_blocks.put(block.hash, block.header())
+        return True
 
-            filtered_transactions = [transaction for transaction in total_transactions if (transaction not in mined_block.transactions)]
+    def verify_transactions(self, block):
+        """Verifies the signatures of the transactions of a received block,
+        most of which are found in the verified cache, since they were
+        verified when they were delivered, skipping the transaction of the
+        genesis block, which isn't signed, and the ones of a pruned block"""
+
+        if block.previous_hash == 1 or block.transactions is None:
+            return True
+        return all(transaction.verify_signature() for transaction in block.transactions)
+
+    def add_block(self, block):
+        """Adds a block that extends the chain, followed by the orphan blocks
+        that extend it in turn, called while holding the chain lock"""
+
+        while block is not None:
+            self.apply_missed(block)
+            with self.mining.paused():
+                self.chain.append(block)
+                self.confirm_block(block)
+            self.validated_blocks.put(block.hash, block.header())
+            self.orphans.remove(block.hash)
+            block = self.orphans.child(block.hash)
+        self.advance_snapshot()
+        self.prune_chain()
+
+    def connect_orphans(self):
+        """Adds the orphan blocks that extend the chain, if there are any"""
+
+        child = self.orphans.child(self.chain.tip())
+        if child is not None:
+            self.add_block(child)
+
+    def expect_parent(self, block):
+        """Fetches the parent of an orphan block that is ahead of the chain by
+        one with a sync, if the block is still waiting for it after
+        ORPHAN_TIMEOUT, since no later block may come to trigger one"""
+
+        timer = Timer(ORPHAN_TIMEOUT, self.fetch_parent, (block,))
+        timer.daemon = True
+        timer.start()
+
+    def fetch_parent(self, block):
+        """Syncs with the peers if an orphan block is still waiting for its
+        parent"""
+
+        with self.chain_lock:
+            if self.orphans.get(block.hash) is not None:
+                self.sync()
+
+    def branch(self, block):
+        """Returns the height where the blocks of the orphan pool that lead to
+        a block fork from the chain, or None if one of them is missing, and
+        the blocks, oldest first"""
+
+        blocks = [block]
+        while True:
+            start = self.chain.height_of(blocks[0].previous_hash)
+            if start is not None:
+                return start + 1, blocks
+
+            parent = self.orphans.get(blocks[0].previous_hash)
+            if parent is None:
+                return None, blocks
+            blocks.insert(0, parent)
+
+    def switch_chain(self, start, blocks):
+        """Replaces the blocks of the chain from height start on with the
+        blocks of a fork, called while holding the chain lock"""
+
+        for block in blocks:
+            self.apply_missed(block)
+
+        with self.mining.paused():
+            # The transactions of the replaced blocks are mined again, except
+            # for the ones of the new blocks
+            self.mempool.restore([transaction for block in self.chain.blocks[start:] for transaction in block.transactions])
+
+            for block in blocks:
+                self.confirm_block(block)
+
+            self.chain.replace(start, blocks)
+
+        if self.snapshot is not None and start < self.snapshot.height:
+            # The fork replaced blocks of the snapshot, which is taken again
+            self.snapshot = None
+            self.snapshot_data = None
+
+        for block in blocks:
+            self.validated_blocks.put(block.hash, block.header())
+            self.orphans.remove(block.hash)
+        self.connect_orphans()
+        self.advance_snapshot()
+        self.prune_chain()
+
+    def can_replace(self, start):
+        """Checks if the blocks of the chain from height start on can be
+        replaced by a fork, which is not the case for the blocks of the
+        snapshot once the chain is pruned, since the snapshot couldn't be
+        taken again"""
+
+        return not self.chain.pruned or start >= self.snapshot.height
+
+    def apply_missed(self, block):
+        """Applies the transactions of a block that the node missed, like the
+        ones of the blocks mined while it was down or the ones that it had
+        added but lost when it was restarted"""
+
+        with self.transaction_lock:
+            for transaction in block.transactions:
+                if self.utxos.missed(transaction):
+                    self.apply_transaction(transaction)
+                    self.connect_orphan_transactions(transaction)
+
+    def has_more_work(self, start, blocks):
+        """Checks if a fork from height start on has more accumulated work
+        than the blocks of the chain that it would replace"""
+
+        fork_work = sum(block.work(MINING_DIFFICULTY) for block in blocks)
+        return fork_work > self.chain.work(start)
+
+    def confirm_block(self, block):
+        """Removes the transactions of a block that was added to the chain
+        from the mempool, which can't be rolled back anymore, and from the
+        orphan transactions"""
+
+        self.utxos.confirm(block.transactions)
+        self.mempool.remove_confirmed(block.transactions)
+        for transaction in block.transactions:
+            self.orphan_transactions.remove(transaction.id)
 
-            if not self.unconfirmed_blocks:
-                self.current_block.transactions = deepcopy(filtered_transactions)
-                return
-
-            i = 0
-            while ((i + 1) * self.capacity <= len(filtered_transactions)):
-                self.unconfirmed_blocks[i].transactions = deepcopy(filtered_transactions[i * self.capacity:(i + 1) * self.capacity])
-                i += 1
+    def share_ring(self, ring_node):
+        """Shares your ring to a specified node"""
 
-            if i * self.capacity < len(filtered_transactions):
-                self.current_block.transactions = deepcopy(filtered_transactions[i * self.capacity:])
+        self.transport.post(ring_node, '/receive_ring', wire.encode_ring(self.ring)).result()
 
-            for i in range(len(self.unconfirmed_blocks) - i):
-                self.unconfirmed_blocks.pop()
+    def share_chain(self, ring_node):
+        """Shares your blockchain to a specified node"""
 
-        return
+        self.transport.post(ring_node, '/receive_chain', wire.encode_chain(self.chain)).result()
+
+    def best_peer(self):
+        """Asks every peer for the accumulated work of its chain, returns the
+        peer with the most work, or None if no chain has more work than the
+        one of the node"""
+
+        peers = self.ring.peers(self.id)
+        futures = [self.transport.get(peer, '/chain_tip') for peer in peers]
+
+        best_peer = None
+        best_work = self.chain.work()
+        for peer, future in zip(peers, futures):
+            try:
+                work = int(future.result().json()['work'])
+            except (requests.RequestException, ValueError, KeyError, TypeError):
+                # Ignore the peers that didn't advertise their tip
+                continue
+            if work > best_work:
+                best_peer = peer
+                best_work = work
+        return best_peer
+
+    def fetch_headers(self, peer):
+        """Fetches the headers of the blocks of a peer after the latest block
+        that its chain shares with the chain of the node, found with a
+        locator, returns the height of the first header and the headers, as
+        pruned blocks, or None"""
+
+        locator = self.chain.locator()
+        start = None
+        headers = []
+        while True:
+            try:
+                response = self.transport.request(peer, 'POST', '/chain_headers', {'locator': locator}).result()
+                range_start, range_headers = wire.decode_headers(response.content)
+            except (requests.RequestException, ValueError):
+                return None
+
+            if start is None:
+                start = range_start
+            elif range_start != start + len(headers):
+                # The chain of the peer changed between two fetches
+                return None
+            headers.extend(range_headers)
+
+            if len(range_headers) < HEADERS_RANGE:
+                return start, headers
+            locator = [headers[-1].hash]
+
+    def fetch_blocks(self, peer, start, headers):
+        """Fetches the blocks of validated headers from a peer, the first of
+        which is at height start, returns the blocks, or None if the peer
+        doesn't send the blocks of the headers"""
+
+        blocks = []
+        while len(blocks) < len(headers):
+            # The peer sends the blocks after the latest fetched one
+            previous_hash = blocks[-1].hash if blocks else self.chain.blocks[start - 1].hash
+            try:
+                response = self.transport.request(peer, 'POST', '/chain_blocks', {'locator': [previous_hash]}).result()
+                range_start, range_blocks = wire.decode_blocks(response.content)
+            except (requests.RequestException, ValueError):
+                return None
+
+            if range_start != start + len(blocks) or not range_blocks:
+                # The chain of the peer changed since the headers were fetched
+                return None
+
+            for block in range_blocks[:len(headers) - len(blocks)]:
+                # The hash of a block covers the root of its transactions, and
+                # the header was validated, so only the fields are compared
+                if block.hash != headers[len(blocks)].hash or not self.validate_hash(block):
+                    return None
+                if not self.verify_transactions(block):
+                    return None
+                blocks.append(block)
+        return blocks
+
+    def validate_chain(self, blocks, previous_hash=1):
+        """Validates the blocks of a chain, or of a part of it that follows
+        the block with the previous hash, computing the hashes of only the
+        blocks that haven't been validated before, and the signatures of
+        their transactions"""
+
+        for block in blocks:
+            if block.previous_hash != previous_hash:
+                return False
 
-    def share_ring(self, ring_node):
-        """Shares your ring to a specified node"""
+            if not self.validate_hash(block) or not self.verify_transactions(block):
+                return False
 
-        address = 'http://' + ring_node['ip'] + ':' + ring_node['port']
-        requests.post(address + '/receive_ring', data=pickle.dumps(self.ring))
+            previous_hash = block.hash
+        return True
 
-    def validate_chain(self, blocks):
-        """Validates all the blocks of a chain"""
+    def validate_blocks(self, start, blocks):
+        """Validates fetched blocks, that extend the chain of the node after
+        the block at height start - 1, without walking the blocks before it,
+        which are already part of the chain"""
 
-        if (blocks[0].previous_hash != 1 or blocks[0].hash != blocks[0].hash_block()):
+        if start == 0 or start > self.chain.height():
             return False
 
-        for i in range(1, len(blocks)):
-            if not (blocks[i].hash == blocks[i].hash_block()) or not (blocks[i].previous_hash == blocks[i - 1].hash):
-                return False
-        return True
+        return self.validate_chain(blocks, self.chain.blocks[start - 1].hash)
 
-    def share_chain(self, ring_node):
-        """Shares your blockchain to a specified node"""
+    def sync(self):
+        """Switches to the chain of the peer with the most work, if it has more
+        work than the chain of the node, headers first: the headers after
+        the fork are fetched and their work and linkage are checked before
+        the blocks are fetched, called while holding the chain lock"""
+
+        peer = self.best_peer()
+        fetched = self.fetch_headers(peer) if peer is not None else None
 
-        address = 'http://' + ring_node['ip'] + ':' + ring_node['port']
-        requests.post(address + '/receive_chain', data=pickle.dumps(self.chain))
+        if fetched:
+            start, headers = fetched
+            if not self.has_more_work(start, headers) or not self.validate_blocks(start, headers):
+                return
+
+            blocks = self.fetch_blocks(peer, start, headers)
+            if blocks is None:
+                return
+
+            if any(block.transactions is None for block in blocks):
+                # The peer has pruned blocks that the node is missing, so the
+                # node continues from the snapshot of the peer
+                self.switch_to_snapshot(peer, start, blocks)
+            elif self.can_replace(start):
+                self.switch_chain(start, blocks)
+
+    def switch_to_snapshot(self, peer, start, blocks):
+        """Replaces the blocks of the chain from height start on with fetched
+        blocks, some of which are pruned, and the state of the node with the
+        snapshot of the peer, called while holding the chain lock"""
+
+        try:
+            snapshot_data = self.transport.get(peer, '/snapshot').result().content
+            snapshot = wire.decode_snapshot(snapshot_data)
+        except (requests.RequestException, ValueError):
+            return
+
+        # The snapshot must follow one of the fetched blocks, and the blocks
+        # after it must have their transactions
+        offset = snapshot.height - start
+        if not 0 < offset <= len(blocks) or blocks[offset - 1].hash != snapshot.block_hash:
+            return
+        if any(block.transactions is None for block in blocks[offset:]):
+            return
+
+        if not self.snapshot_confirmed(snapshot, snapshot_data):
+            return
+
+        with self.mining.paused(), self.transaction_lock:
+            # The waiting transactions were added to the state that is replaced
+            self.mempool.clear()
+            self.utxos.clear()
+            for ring_node in self.ring:
+                ring_node['balance'] = 0
+            self.restore_snapshot(snapshot, snapshot_data)
+
+            for block in blocks[offset:]:
+                for transaction in block.transactions:
+                    self.apply_transaction(transaction)
+                self.confirm_block(block)
+
+            self.chain.replace(start, blocks)
+            self.prune_blocks(snapshot.height)
+
+        if self.data_dir is not None:
+            store.save_snapshot(self.data_dir, snapshot_data)
+
+        for block in blocks:
+            self.validated_blocks.put(block.hash, block.header())
+            self.orphans.remove(block.hash)
+        self.connect_orphans()
+        self.advance_snapshot()
+        self.prune_chain()
+
+    def snapshot_confirmed(self, snapshot, snapshot_data):
+        """Checks that more than half of the peers report the commitment of a
+        fetched snapshot for its height, since the pruned blocks before it
+        can't be replayed in order to check its state"""
+
+        commitment = hashlib.sha256(snapshot_data).hexdigest()
+        peers = self.ring.peers(self.id)
+        futures = [self.transport.get(peer, '/api/get_metrics') for peer in peers]
+
+        confirmations = 0
+        for future in futures:
+            try:
+                reported = future.result().json()['snapshot']
+                if reported['height'] == snapshot.height and reported['commitment'] == commitment:
+                    confirmations += 1
+            except (requests.RequestException, ValueError, KeyError, TypeError):
+                # Ignore the peers that didn't report their snapshot
+                continue
+        return confirmations > len(peers) // 2
 
     def resolve_conflicts(self, new_block):
-        """Resolves conflicts of multiple blockchains, by keeping the longest chain
-        when a new block that can't be validated is received"""
-
-        def thread_func(node, chains):
-            address = 'http://' + node['ip'] + ':' + node['port']
-            response = requests.get(address + "/send_chain")
-            new_blockchain = pickle.loads(response._content)
-            chains.append(new_blockchain)
-
-        threads = []
-        chains = []
-        for node in self.ring:
-            if node['id'] != self.id:
-                thread = Thread(target=thread_func, args=(node, chains))
-                threads.append(thread)
-                thread.start()
-
-        for thread in threads:
-            thread.join()
-
-        selected_chain = self.chain
-        for chain in chains:
-            if (self.validate_chain(chain.blocks) and (len(chain.blocks) > len(selected_chain.blocks))):
-                selected_chain = chain
-
-        if selected_chain != self.chain:
-            self.stop_mining = True
-            with self.filter_lock:
-                i = len(selected_chain.blocks) - 1
-                while (i > 0 and ((selected_chain.blocks[i].hash != self.chain.blocks[-1].hash))):
-                    i -= 1
-
-                for block in reversed(self.chain.blocks[i + 1:]):
-                    self.unconfirmed_blocks.appendleft(block)
-
-                for block in selected_chain.blocks[i + 1:]:
-                    self.filter_blocks(block)
-
-                self.chain = selected_chain
-                self.stop_mining = False
+        """Resolves conflicts of multiple blockchains, by switching to the
+        chain with the most work when a new block can't be connected to the
+        chain, fetching only the blocks after the fork from the peer that has
+        it, called as a last resort while holding the chain lock"""
+
+        self.sync()
         return self.validate_block(new_block)
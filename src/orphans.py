@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from threading import RLock
+
+# Max number of blocks in the pool, the oldest ones are dropped first
+ORPHAN_CAPACITY = 64
+
+# Max number of transactions in the pool, the oldest ones are dropped first
+ORPHAN_TRANSACTION_CAPACITY = 256
+
+class OrphanPool:
+    """
+    Class for the pool of the received blocks that don't extend the chain of
+    a node, either because their parent hasn't arrived yet or because they
+    belong to a fork, until they can be connected
+
+    capacity: max number of blocks in the pool
+    blocks: blocks by hash, oldest first
+    children: hashes of the blocks of the pool by previous hash
+    lock: reentrant lock in order to provide mutual exclusion while updating the pool
+    """
+
+    def __init__(self, capacity=ORPHAN_CAPACITY):
+        """Initializes an OrphanPool"""
+
+        self.capacity = capacity
+        self.blocks = OrderedDict()
+        self.children = {}
+        self.lock = RLock()
+
+    def __len__(self):
+        """Number of blocks in the pool"""
+
+        return len(self.blocks)
+
+    def add(self, block):
+        """Adds a block to the pool, dropping the oldest one if it is full"""
+
+        with self.lock:
+            if block.hash in self.blocks:
+                return
+
+            self.blocks[block.hash] = block
+            self.children.setdefault(block.previous_hash, []).append(block.hash)
+
+            if len(self.blocks) > self.capacity:
+                self.remove(next(iter(self.blocks)))
+
+    def get(self, block_hash):
+        """Returns the block of the pool with a hash, or None"""
+
+        return self.blocks.get(block_hash)
+
+    def child(self, previous_hash):
+        """Returns the oldest block of the pool whose parent has a hash, or None"""
+
+        with self.lock:
+            hashes = self.children.get(previous_hash)
+            return self.blocks[hashes[0]] if hashes else None
+
+    def remove(self, block_hash):
+        """Removes a block from the pool, if it is there"""
+
+        with self.lock:
+            block = self.blocks.pop(block_hash, None)
+            if block is None:
+                return
+
+            siblings = self.children[block.previous_hash]
+            siblings.remove(block_hash)
+            if not siblings:
+                del self.children[block.previous_hash]
+
+
+class OrphanTransactionPool:
+    """
+    Class for the pool of the received transactions of other nodes that spend
+    outputs that the node hasn't seen yet, until the transactions that add
+    those outputs are applied
+
+    capacity: max number of transactions in the pool
+    transactions: transactions by id, oldest first
+    missing: outpoints that every transaction of the pool is missing, by id
+    waiting: ids of the transactions of the pool by missing outpoint
+    lock: reentrant lock in order to provide mutual exclusion while updating the pool
+    """
+
+    def __init__(self, capacity=ORPHAN_TRANSACTION_CAPACITY):
+        """Initializes an OrphanTransactionPool"""
+
+        self.capacity = capacity
+        self.transactions = OrderedDict()
+        self.missing = {}
+        self.waiting = {}
+        self.lock = RLock()
+
+    def __len__(self):
+        """Number of transactions in the pool"""
+
+        return len(self.transactions)
+
+    def __contains__(self, transaction_id):
+        """Checks if a transaction is in the pool"""
+
+        return transaction_id in self.transactions
+
+    def add(self, transaction, outpoints):
+        """Adds a transaction that is missing the outputs of outpoints to the
+        pool, dropping the oldest one if it is full"""
+
+        with self.lock:
+            if transaction.id in self.transactions:
+                return
+
+            self.transactions[transaction.id] = transaction
+            self.missing[transaction.id] = set(outpoints)
+            for outpoint in outpoints:
+                self.waiting.setdefault(outpoint, []).append(transaction.id)
+
+            if len(self.transactions) > self.capacity:
+                self.remove(next(iter(self.transactions)))
+
+    def resolve(self, transaction):
+        """Removes and returns the transactions of the pool that were missing
+        only outputs of a transaction that was applied, oldest first"""
+
+        with self.lock:
+            resolved = []
+            for index in range(len(transaction.outputs)):
+                for transaction_id in self.waiting.pop((transaction.id, index), []):
+                    missing = self.missing[transaction_id]
+                    missing.discard((transaction.id, index))
+                    if not missing:
+                        resolved.append(self.transactions[transaction_id])
+
+            for resolved_transaction in resolved:
+                self.remove(resolved_transaction.id)
+            return resolved
+
+    def remove(self, transaction_id):
+        """Removes a transaction from the pool, if it is there"""
+
+        with self.lock:
+            if self.transactions.pop(transaction_id, None) is None:
+                return
+
+            for outpoint in self.missing.pop(transaction_id):
+                waiting = self.waiting.get(outpoint)
+                if waiting is None:
+                    continue
+                waiting.remove(transaction_id)
+                if not waiting:
+                    del self.waiting[outpoint]
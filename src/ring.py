@@ -0,0 +1,65 @@
+from wallet import key_fingerprint, register_key
+from signature import DEFAULT_SCHEME
+
+class Ring:
+    """
+    Class for the directory of the nodes of the ring
+
+    nodes: information about every node (id, ip, port, public_key, balance,
+    address) by node id, in registration order
+    keys: the same information by the fingerprint of the node's public key
+    scheme: name of the signature scheme that all the nodes use
+    """
+
+    def __init__(self):
+        """Initializes a Ring"""
+
+        self.nodes = {}
+        self.keys = {}
+        self.scheme = DEFAULT_SCHEME
+
+    def __str__(self):
+        """String representation of a Ring"""
+
+        return str(self.__class__) + ": " + str(self.__dict__)
+
+    def __iter__(self):
+        """Iterates over the information of the nodes"""
+
+        return iter(self.nodes.values())
+
+    def __len__(self):
+        """Number of nodes in the ring"""
+
+        return len(self.nodes)
+
+    def register(self, id, ip, port, public_key, balance):
+        """Adds a node to the ring and its public key to the key registry, and
+        caches its base url"""
+
+        public_key = register_key(public_key)
+        ring_node = {
+            'id': id,
+            'ip': ip,
+            'port': port,
+            'public_key': public_key,
+            'balance': balance,
+            'address': 'http://' + ip + ':' + str(port)
+        }
+        self.nodes[id] = ring_node
+        self.keys[key_fingerprint(public_key)] = ring_node
+
+    def get(self, id):
+        """Returns the node with the given id, or None"""
+
+        return self.nodes.get(id)
+
+    def find_by_key(self, public_key):
+        """Returns the node with the given public key, or None"""
+
+        return self.keys.get(key_fingerprint(public_key))
+
+    def peers(self, id):
+        """Returns all the nodes except the one with the given id"""
+
+        return [ring_node for ring_node in self.nodes.values() if ring_node['id'] != id]
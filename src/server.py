@@ -0,0 +1,229 @@
+import io
+import sys
+import asyncio
+
+from http import HTTPStatus
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+
+# Max number of requests that are served at the same time, the rest wait for
+# a slot, a connection only takes a slot while one of its requests is served
+MAX_REQUESTS = 512
+
+# Seconds that a kept alive connection can stay idle before it is closed, so
+# that the pooled connections of the peers don't stay open forever
+IDLE_TIMEOUT = 30
+
+# Number of threads that run the endpoints, so that the event loop never
+# blocks on verification, mining or on waiting for the peers. An endpoint
+# that waits for the peers, like a sync, still holds its thread until they
+# answer, so at most that many requests can wait for the peers at once, and
+# the endpoints that wait for the chain lock take at most MAX_CHAIN_WAITERS
+# of them
+HANDLER_THREADS = 64
+
+# Max size of the request line and the headers of a request
+MAX_HEADER_SIZE = 65536
+
+class AsyncServer:
+    """
+    Class for an asyncio http server that serves a wsgi application, with a
+    coroutine instead of a thread for every connection
+
+    app: the wsgi application
+    host: address to listen on
+    port: port to listen on
+    max_requests: max number of requests that are served at the same time
+    executor: threads that run the application
+    requests: semaphore in order to limit the number of requests
+    """
+
+    def __init__(self, app, host, port, max_requests=MAX_REQUESTS, handler_threads=HANDLER_THREADS):
+        """Initializes an AsyncServer"""
+
+        self.app = app
+        self.host = host
+        self.port = int(port)
+        self.max_requests = max_requests
+        self.executor = ThreadPoolExecutor(handler_threads)
+        self.requests = None
+
+    def serve(self):
+        """Serves requests forever"""
+
+        asyncio.run(self.main())
+
+    async def main(self):
+        """Starts listening and serves the connections"""
+
+        # The semaphore must be created inside the event loop
+        self.requests = asyncio.Semaphore(self.max_requests)
+        server = await asyncio.start_server(
+            self.handle, self.host, self.port, limit=MAX_HEADER_SIZE, backlog=self.max_requests)
+        print(" * Serving on http://%s:%d with asyncio" % (self.host, self.port))
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """Serves the requests of a connection, while it is kept alive and
+        doesn't stay idle for longer than IDLE_TIMEOUT"""
+
+        try:
+            keep_alive = True
+            while keep_alive:
+                keep_alive = await self.handle_request(reader, writer)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader, writer):
+        """Reads a request, runs the application on it in the executor and
+        writes the response, returns whether the connection is kept alive"""
+
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # The connection stayed idle for too long
+            return False
+        except asyncio.IncompleteReadError as error:
+            if error.partial:
+                raise
+            # The client closed the connection between requests
+            return False
+
+        try:
+            environ = self.environ(head, writer)
+        except ValueError:
+            await self.write_error(writer, HTTPStatus.BAD_REQUEST)
+            return False
+
+        if 'chunked' in environ.pop('HTTP_TRANSFER_ENCODING', '').lower():
+            try:
+                body = await self.read_chunked(reader)
+            except ValueError:
+                await self.write_error(writer, HTTPStatus.BAD_REQUEST)
+                return False
+            # The application sees the body as a plain one
+            environ['CONTENT_LENGTH'] = str(len(body))
+        else:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body = await asyncio.wait_for(reader.readexactly(length), IDLE_TIMEOUT) if length else b''
+        environ['wsgi.input'] = io.BytesIO(body)
+
+        loop = asyncio.get_running_loop()
+        async with self.requests:
+            status, headers, body = await loop.run_in_executor(self.executor, self.run_app, environ)
+
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        names = {name.lower() for name, _ in headers}
+        if 'content-length' not in names:
+            headers.append(('Content-Length', str(len(body))))
+        headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+
+        writer.write(self.response_head(status, headers) + body)
+        await writer.drain()
+        return keep_alive
+
+    async def read_chunked(self, reader):
+        """Reads a body with the chunked transfer encoding, its chunks up to
+        the last empty one and the trailers after it, which are ignored"""
+
+        chunks = []
+        while True:
+            line = await asyncio.wait_for(reader.readuntil(b'\r\n'), IDLE_TIMEOUT)
+            # The size can be followed by chunk extensions
+            size = int(line.split(b';', 1)[0].strip(), 16)
+            if size < 0:
+                raise ValueError('Malformed chunk size')
+            if size == 0:
+                break
+
+            chunk = await asyncio.wait_for(reader.readexactly(size + 2), IDLE_TIMEOUT)
+            if not chunk.endswith(b'\r\n'):
+                raise ValueError('Malformed chunk')
+            chunks.append(chunk[:-2])
+
+        while await asyncio.wait_for(reader.readuntil(b'\r\n'), IDLE_TIMEOUT) != b'\r\n':
+            pass
+        return b''.join(chunks)
+
+    def environ(self, head, writer):
+        """Builds the wsgi environment of a request from its request line and
+        its headers"""
+
+        lines = head.decode('ISO-8859-1').split('\r\n')
+        method, target, protocol = lines[0].split()
+        path, _, query = target.partition('?')
+        host, port = writer.get_extra_info('peername')[:2]
+
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'ISO-8859-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': host,
+            'REMOTE_PORT': str(port),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, separator, value = line.partition(':')
+            if not separator:
+                raise ValueError('Malformed header')
+            key = name.strip().upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[key] = value.strip()
+            else:
+                environ['HTTP_' + key] = value.strip()
+
+        if not environ.get('CONTENT_LENGTH', '0').isdigit():
+            raise ValueError('Malformed content length')
+        return environ
+
+    def run_app(self, environ):
+        """Runs the application on a request, returns the status, the headers
+        and the body of the response"""
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = list(headers)
+
+        result = self.app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], body
+
+    def response_head(self, status, headers):
+        """Returns the status line and the headers of a response"""
+
+        lines = ['HTTP/1.1 ' + status]
+        lines += ['%s: %s' % header for header in headers]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('ISO-8859-1')
+
+    async def write_error(self, writer, status):
+        """Writes an empty error response and closes the connection"""
+
+        headers = [('Content-Length', '0'), ('Connection', 'close')]
+        writer.write(self.response_head('%d %s' % (status.value, status.phrase), headers))
+        await writer.drain()
@@ -0,0 +1,114 @@
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import ECC, RSA
+from Crypto.Signature import DSS, eddsa, pss
+
+class RSAScheme:
+    """Signature scheme with 2048-bit RSA keys in PEM and PSS signatures"""
+
+    name = 'rsa'
+
+    def generate(self):
+        """Generates a key pair, returns the private and the public key"""
+
+        key = RSA.generate(2048)
+        return (key.exportKey().decode("ISO-8859-1"),
+                key.publickey().exportKey().decode("ISO-8859-1"))
+
+    def import_key(self, key):
+        """Parses a private or public key"""
+
+        return RSA.importKey(key.encode("ISO-8859-1"))
+
+    def sign(self, key, data):
+        """Signs data with a parsed private key"""
+
+        return pss.new(key).sign(SHA256.new(data))
+
+    def verify(self, key, data, signature):
+        """Verifies the signature of data with a parsed public key"""
+
+        try:
+            pss.new(key).verify(SHA256.new(data), signature)
+            return True
+        except (ValueError, TypeError):
+            return False
+
+class Ed25519Scheme:
+    """Signature scheme with Ed25519 keys in DER and EdDSA signatures"""
+
+    name = 'ed25519'
+
+    def generate(self):
+        """Generates a key pair, returns the private and the public key"""
+
+        key = ECC.generate(curve='ed25519')
+        return (key.export_key(format='DER').decode("ISO-8859-1"),
+                key.public_key().export_key(format='DER').decode("ISO-8859-1"))
+
+    def import_key(self, key):
+        """Parses a private or public key"""
+
+        return ECC.import_key(key.encode("ISO-8859-1"))
+
+    def sign(self, key, data):
+        """Signs data with a parsed private key"""
+
+        return eddsa.new(key, 'rfc8032').sign(data)
+
+    def verify(self, key, data, signature):
+        """Verifies the signature of data with a parsed public key"""
+
+        try:
+            eddsa.new(key, 'rfc8032').verify(data, signature)
+            return True
+        except (ValueError, TypeError):
+            return False
+
+class ECDSAScheme:
+    """Signature scheme with P-256 keys in compressed DER and ECDSA signatures"""
+
+    name = 'ecdsa'
+
+    def generate(self):
+        """Generates a key pair, returns the private and the public key"""
+
+        key = ECC.generate(curve='P-256')
+        return (key.export_key(format='DER').decode("ISO-8859-1"),
+                key.public_key().export_key(format='DER', compress=True).decode("ISO-8859-1"))
+
+    def import_key(self, key):
+        """Parses a private or public key"""
+
+        return ECC.import_key(key.encode("ISO-8859-1"))
+
+    def sign(self, key, data):
+        """Signs data with a parsed private key"""
+
+        return DSS.new(key, 'fips-186-3').sign(SHA256.new(data))
+
+    def verify(self, key, data, signature):
+        """Verifies the signature of data with a parsed public key"""
+
+        try:
+            DSS.new(key, 'fips-186-3').verify(SHA256.new(data), signature)
+            return True
+        except (ValueError, TypeError):
+            return False
+
+# Available signature schemes by name
+SCHEMES = {scheme.name: scheme for scheme in (RSAScheme(), Ed25519Scheme(), ECDSAScheme())}
+
+# Signature scheme of the ring, selected by the bootstrap node
+DEFAULT_SCHEME = 'rsa'
+current_scheme = SCHEMES[DEFAULT_SCHEME]
+
+def get_scheme():
+    """Returns the signature scheme of the ring"""
+
+    return current_scheme
+
+def set_scheme(name):
+    """Selects the signature scheme of the ring"""
+
+    global current_scheme
+    current_scheme = SCHEMES[name]
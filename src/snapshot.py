@@ -0,0 +1,32 @@
+from utxo import UTXOSet
+
+class Snapshot:
+    """
+    Class for the state of the ring after the first blocks of a chain, so
+    that it doesn't have to be rebuilt by replaying them
+
+    height: number of blocks that the state includes
+    block_hash: hash of the last block that the state includes
+    utxos: unspent transaction outputs after the blocks
+    balances: balance of every public key after the blocks
+    """
+
+    def __init__(self, height=0, block_hash=None):
+        """Initializes an empty Snapshot"""
+
+        self.height = height
+        self.block_hash = block_hash
+        self.utxos = UTXOSet()
+        self.balances = {}
+
+    def apply(self, block):
+        """Advances the state by the next block of the chain"""
+
+        for transaction in block.transactions:
+            self.utxos.add_transaction(transaction)
+            self.balances[transaction.sender] = self.balances.get(transaction.sender, 0) - transaction.amount
+            self.balances[transaction.receiver] = self.balances.get(transaction.receiver, 0) + transaction.amount
+        self.utxos.confirm(block.transactions)
+
+        self.height += 1
+        self.block_hash = block.hash
@@ -0,0 +1,228 @@
+import os
+import json
+import mmap
+import struct
+
+import wire
+
+# Max size of a segment file, the next blocks are appended to a new segment
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Index record of a block: segment, offset and length of the encoded block in
+# the segment, the hash of the block and the root of the Merkle tree of its
+# transactions, so that its header is read without its transactions
+INDEX_RECORD = struct.Struct('>IQI32s32s')
+
+INDEX_FILE = 'index.dat'
+SEGMENT_FILE = 'blocks-%05d.dat'
+STATE_FILE = 'state.json'
+SNAPSHOT_FILE = 'snapshot.dat'
+
+class BlockStore:
+    """
+    Class for the append-only store of the blocks of a chain on disk, in
+    segment files with the wire encoding of the blocks and an index file with
+    a fixed size record for every block
+
+    directory: directory of the files
+    segment_size: max size of a segment file
+    positions: segment, offset and length of every block by height
+    heights: height of every block by hash
+    roots: root of the Merkle tree of the transactions of every block by height
+    index_file: index file, opened for appending
+    segment_file: last segment file, opened for appending
+    maps: memory maps of the segments, used for reading
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        """Initializes a BlockStore and loads the index of the blocks that
+        are already in the directory"""
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.positions = []
+        self.heights = {}
+        self.roots = []
+        self.maps = {}
+
+        os.makedirs(directory, exist_ok=True)
+        index_path = os.path.join(directory, INDEX_FILE)
+        with open(index_path, 'ab+') as index_file:
+            index_file.seek(0)
+            index = index_file.read()
+
+        lengths = {}
+        for segment, offset, length, block_hash, merkle_root in INDEX_RECORD.iter_unpack(
+                index[:len(index) - len(index) % INDEX_RECORD.size]):
+            if segment not in lengths:
+                lengths[segment] = self.segment_length(segment)
+            # A block whose write was interrupted is dropped with the ones after it
+            if offset + length > lengths[segment]:
+                break
+            self.heights[block_hash.hex()] = len(self.positions)
+            self.positions.append((segment, offset, length))
+            self.roots.append(merkle_root)
+
+        # Drop whatever was written after the last complete block
+        self.index_file = open(index_path, 'rb+')
+        self.index_file.truncate(len(self.positions) * INDEX_RECORD.size)
+        self.index_file.seek(0, os.SEEK_END)
+
+        segment, offset, length = self.positions[-1] if self.positions else (0, 0, 0)
+        self.segment_file = open(self.segment_path(segment), 'ab+')
+        self.segment_file.truncate(offset + length)
+        self.segment = segment
+
+    def __len__(self):
+        """Number of blocks in the store"""
+
+        return len(self.positions)
+
+    def segment_path(self, segment):
+        """Returns the path of a segment file"""
+
+        return os.path.join(self.directory, SEGMENT_FILE % segment)
+
+    def segment_length(self, segment):
+        """Returns the size of a segment file, 0 if it doesn't exist"""
+
+        try:
+            return os.path.getsize(self.segment_path(segment))
+        except OSError:
+            return 0
+
+    def append(self, block):
+        """Appends a block after the last one, the block is written before
+        its index record, so that an interrupted write is never indexed"""
+
+        data = wire.encode_block(block)
+        offset = self.segment_file.seek(0, os.SEEK_END)
+        if offset and offset + len(data) > self.segment_size:
+            # Start a new segment
+            self.segment_file.close()
+            self.segment += 1
+            self.segment_file = open(self.segment_path(self.segment), 'ab+')
+            offset = 0
+
+        self.segment_file.write(data)
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+
+        self.index_file.write(INDEX_RECORD.pack(self.segment, offset, len(data), bytes.fromhex(block.hash),
+                                                block.root()))
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+
+        self.heights[block.hash] = len(self.positions)
+        self.positions.append((self.segment, offset, len(data)))
+        self.roots.append(block.root())
+
+    def truncate(self, height):
+        """Removes the blocks from a height on, when the end of the chain is
+        replaced by a fork"""
+
+        if height >= len(self.positions):
+            return
+
+        segment, offset, _ = self.positions[height]
+        for removed_segment in range(segment + 1, self.segment + 1):
+            self.unmap(removed_segment)
+            os.remove(self.segment_path(removed_segment))
+
+        self.unmap(segment)
+        self.segment_file.close()
+        self.segment_file = open(self.segment_path(segment), 'ab+')
+        self.segment_file.truncate(offset)
+        self.segment = segment
+
+        self.index_file.truncate(height * INDEX_RECORD.size)
+        self.index_file.seek(0, os.SEEK_END)
+
+        for block_hash in [block_hash for block_hash, block_height in self.heights.items() if block_height >= height]:
+            del self.heights[block_hash]
+        del self.positions[height:]
+        del self.roots[height:]
+
+    def unmap(self, segment):
+        """Closes the memory map of a segment, if it is mapped"""
+
+        segment_map = self.maps.pop(segment, None)
+        if segment_map is not None:
+            segment_map.close()
+
+    def read(self, height):
+        """Reads the block at a height through the memory map of its segment"""
+
+        return wire.decode_block(self.encoded(height))
+
+    def read_header(self, height):
+        """Reads only the header of the block at a height, as a pruned block,
+        without decoding its transactions"""
+
+        return wire.decode_block_header(self.encoded(height), self.roots[height])
+
+    def encoded(self, height):
+        """Returns the encoding of the block at a height, through the memory
+        map of its segment"""
+
+        segment, offset, length = self.positions[height]
+        segment_map = self.maps.get(segment)
+        if segment_map is None or offset + length > len(segment_map):
+            # The segment is mapped again when it has grown since it was mapped
+            self.unmap(segment)
+            with open(self.segment_path(segment), 'rb') as segment_file:
+                segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = segment_map
+
+        return segment_map[offset:offset + length]
+
+    def blocks(self, pruned=0):
+        """Reads all the blocks, from the genesis block on, only the headers
+        of the ones before height pruned"""
+
+        for height in range(len(self.positions)):
+            yield self.read_header(height) if height < pruned else self.read(height)
+
+    def height_of(self, block_hash):
+        """Returns the height of a stored block, or None"""
+
+        return self.heights.get(block_hash)
+
+def save_state(directory, state):
+    """Saves the state of a node, which includes its private key, so the file
+    is only readable by its owner"""
+
+    path = os.path.join(directory, STATE_FILE)
+    temporary_path = path + '.tmp'
+    descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_path, path)
+
+def load_state(directory):
+    """Loads the saved state of a node, or returns None"""
+
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+def save_snapshot(directory, data):
+    """Saves the encoding of the latest snapshot, replacing the previous one"""
+
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    with open(path + '.tmp', 'wb') as snapshot_file:
+        snapshot_file.write(data)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(path + '.tmp', path)
+
+def load_snapshot(directory):
+    """Loads the encoding of the latest snapshot, or returns None"""
+
+    try:
+        with open(os.path.join(directory, SNAPSHOT_FILE), 'rb') as snapshot_file:
+            return snapshot_file.read()
+    except OSError:
+        return None
@@ -1,8 +1,32 @@
-import Crypto
-import Crypto.Random
-from Crypto.Hash import SHA256
-from Crypto.PublicKey import RSA
-from Crypto.Signature import pss
+import struct
+import hashlib
+from copy import deepcopy
+
+from cache import LRUCache
+from signature import get_scheme
+from wallet import key_fingerprint
+
+# Parsed keys by the fingerprint of their encoding
+key_cache = LRUCache(1024)
+
+# Transactions with a valid signature, by (id, signature, sender fingerprint)
+verified_cache = LRUCache(65536)
+
+# Numeric content of a Transaction: sender id, receiver id, amount and total
+CONTENT_FIELDS = struct.Struct('>qqqq')
+
+# Length of a key and index of an input in the content of a Transaction
+LENGTH = struct.Struct('>I')
+
+def import_key(key):
+    """Parses a key with the signature scheme of the ring, once per key"""
+
+    fingerprint = key_fingerprint(key)
+    parsed_key = key_cache.get(fingerprint)
+    if parsed_key is None:
+        parsed_key = get_scheme().import_key(key)
+        key_cache.put(fingerprint, parsed_key)
+    return parsed_key
 
 class Transaction:
     """
@@ -15,11 +39,17 @@ class Transaction:
     amount: amount of nbc to transfer
     total: total amount that sender sends
     inputs: list of TransactionInput
-    id: hash of the transaction
+    id: sha256 of the content of the transaction, 32 bytes
     outputs: list of TransactionOutput
     signature: signature of the transaction
+    sealed: whether the Transaction is signed and can't be modified anymore,
+    so that it is shared by reference instead of copied
     """
 
+    # A long running node keeps every transaction, so they have no __dict__
+    __slots__ = ('sender', 'sender_id', 'receiver', 'receiver_id', 'amount', 'total',
+                 'inputs', 'id', 'outputs', 'signature', 'sealed')
+
     def __init__(self, sender, sender_id, receiver, receiver_id, amount, total, inputs, id=None, outputs=None, signature=None):
         """Initializes a Transaction"""
         
@@ -42,6 +72,75 @@ class Transaction:
             self.calculate_outputs()
 
         self.signature = signature
+        self.sealed = False
+
+    @classmethod
+    def received(cls, sender, sender_id, receiver, receiver_id, amount, total, inputs, id, outputs, signature):
+        """Creates a sealed Transaction from the fields of a received one,
+        without computing its id and outputs, which matches_content checks
+        when it is validated, and without the checks of __setattr__"""
+
+        # Every field is set directly, which is twice as fast as __setstate__
+        transaction = object.__new__(cls)
+        set_field = object.__setattr__
+        set_field(transaction, 'sender', sender)
+        set_field(transaction, 'sender_id', sender_id)
+        set_field(transaction, 'receiver', receiver)
+        set_field(transaction, 'receiver_id', receiver_id)
+        set_field(transaction, 'amount', amount)
+        set_field(transaction, 'total', total)
+        set_field(transaction, 'inputs', tuple(inputs))
+        set_field(transaction, 'id', id)
+        set_field(transaction, 'outputs', tuple(outputs))
+        set_field(transaction, 'signature', signature)
+        set_field(transaction, 'sealed', True)
+        return transaction
+
+    def __setattr__(self, name, value):
+        """Rejects any change to a sealed Transaction"""
+
+        if getattr(self, 'sealed', False):
+            raise AttributeError("sealed transaction can't be modified")
+        object.__setattr__(self, name, value)
+
+    def __copy__(self):
+        """A sealed Transaction is immutable, so it's its own copy"""
+
+        if self.sealed:
+            return self
+        replica = object.__new__(Transaction)
+        replica.__setstate__(self.__getstate__())
+        return replica
+
+    def __deepcopy__(self, memo):
+        """A sealed Transaction is immutable, so it's its own copy"""
+
+        if self.sealed:
+            return self
+        replica = object.__new__(Transaction)
+        replica.__setstate__(deepcopy(self.__getstate__(), memo))
+        return replica
+
+    def __getstate__(self):
+        """Returns the fields of the Transaction, for pickling"""
+
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        """Restores the fields of an unpickled Transaction, even if it is
+        sealed"""
+
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+    def seal(self):
+        """Freezes the Transaction, after it has been signed or received"""
+
+        if self.inputs is not None:
+            self.inputs = tuple(self.inputs)
+        self.outputs = tuple(self.outputs)
+        self.sealed = True
+        return self
 
     def __eq__(self, transaction):
         """Overrides the default method and checks the equality of 2 Transaction
@@ -52,7 +151,7 @@ class Transaction:
     def __str__(self):
         """String representation of a Transaction"""
         
-        return str(self.__class__) + ": " + str(self.__dict__)
+        return str(self.__class__) + ": " + str(self.__getstate__())
 
     def convert_to_list(self):
         """List representation of a Transaction"""
@@ -60,10 +159,38 @@ class Transaction:
         return [self.sender_id, self.receiver_id, self.amount, self.total, self.total - self.amount]
 
     def hash_transaction(self):
-        """Calculates the hash of the Transaction"""
+        """Calculates the hash of the Transaction, from its participants, its
+        amounts and the outputs that it spends, so that the same transaction
+        always has the same id"""
 
-        # The hash is a random integer, at most 256 bits long.
-        return Crypto.Random.get_random_bytes(256).decode("ISO-8859-1")
+        content = hashlib.sha256(CONTENT_FIELDS.pack(
+            int(self.sender_id), int(self.receiver_id), self.amount, self.total))
+
+        for key in (self.sender, self.receiver):
+            encoded = key.encode("ISO-8859-1")
+            content.update(LENGTH.pack(len(encoded)))
+            content.update(encoded)
+
+        # The inputs have a fixed size and come last
+        for transaction_input in self.inputs or []:
+            content.update(transaction_input.output_id)
+            content.update(LENGTH.pack(transaction_input.index))
+
+        return content.digest()
+
+    def matches_content(self):
+        """Checks that the id and the outputs of a received Transaction are
+        the ones that follow from its content"""
+
+        if self.id != self.hash_transaction():
+            return False
+
+        expected = [(self.receiver, self.amount)]
+        if self.total > self.amount:
+            expected.append((self.sender, self.total - self.amount))
+
+        outputs = [(output.transaction_id, output.target, output.amount) for output in self.outputs]
+        return outputs == [(self.id, target, amount) for target, amount in expected]
 
     def calculate_outputs(self):
         """Computes Transaction outputs"""
@@ -77,35 +204,53 @@ class Transaction:
     def sign_transaction(self, private_key):
         """Signs the Transaction using a private key"""
 
-        temp = self.id.encode("ISO-8859-1")
-        key = RSA.importKey(private_key.encode("ISO-8859-1"))
-        hashed = SHA256.new(temp)
-        signer = pss.new(key)
-        self.signature = signer.sign(hashed).decode("ISO-8859-1")
+        key = import_key(private_key)
+        signature = get_scheme().sign(key, self.id)
+        self.signature = signature.decode("ISO-8859-1")
+        self.seal()
 
     def verify_signature(self):
-        """Verifies the signature of a Transaction"""
+        """Verifies the signature of a Transaction, skipping the transactions
+        that have already been verified"""
 
-        key = RSA.importKey(self.sender.encode("ISO-8859-1"))
-        hashed = SHA256.new(self.id.encode("ISO-8859-1"))
-        verifier = pss.new(key)
-        try:
-            verifier.verify(hashed, self.signature.encode("ISO-8859-1"))
+        if self.signature is None:
+            return False
+
+        cache_key = (self.id, self.signature, key_fingerprint(self.sender))
+        if verified_cache.get(cache_key):
             return True
-        except (ValueError, TypeError):
+
+        try:
+            key = import_key(self.sender)
+        except (ValueError, TypeError, IndexError):
+            return False
+
+        if not get_scheme().verify(key, self.id, self.signature.encode("ISO-8859-1")):
             return False
 
+        verified_cache.put(cache_key, True)
+        return True
+
 class TransactionInput:
     """
     Class for a TransactionInput of a Transaction
     
-    output_id: id of the TransactionOutput that is used as TransactionInput
+    output_id: id of the transaction of the TransactionOutput that is used as TransactionInput
+    index: position of the TransactionOutput in the outputs of its transaction
     """
 
-    def __init__(self, output_id):
+    __slots__ = ('output_id', 'index')
+
+    def __init__(self, output_id, index):
         """Initiliazes a TransactionInput"""
         
         self.output_id = output_id
+        self.index = index
+
+    def outpoint(self):
+        """Returns the (transaction id, index) pair of the spent output"""
+
+        return (self.output_id, self.index)
 
 
 class TransactionOutput:
@@ -115,18 +260,18 @@ class TransactionOutput:
     transaction_id: id of the transaction
     target: target of the TransactionOutput
     amount: amount of nbc to be credited to the target
-    unspent: boolean of whether this output has been used or not
     """
 
+    __slots__ = ('transaction_id', 'target', 'amount')
+
     def __init__(self, transaction_id, target, amount):
         """Initiliazes a TransactionOutput"""
 
         self.transaction_id = transaction_id
         self.target = target
         self.amount = amount
-        self.unspent = True
 
     def __str__(self):
         """String representation of a Transaction Output object"""
 
-        return str(self.__dict__)
+        return str({name: getattr(self, name) for name in self.__slots__})
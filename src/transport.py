@@ -0,0 +1,185 @@
+import time
+import requests
+
+from queue import Full, Queue
+from threading import Lock, Thread
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# Number of pooled connections of every peer, one for its sender worker and
+# one for the requests that don't wait behind its messages
+PEER_CONNECTIONS = 2
+
+# Number of threads that send the requests that don't wait behind the
+# messages of a peer, shared by all the peers
+REQUEST_THREADS = 16
+
+# Max number of messages waiting to be sent to a peer, the next messages to
+# that peer fail until its queue drains, without blocking their sender
+QUEUE_SIZE = 1024
+
+# Seconds after which a request to a peer fails, so that a stuck peer can't
+# keep its worker busy forever
+TIMEOUT = 120
+
+class Peer:
+    """
+    Class for the connection of a node to one of its peers
+
+    address: base url of the peer
+    session: http session that keeps its connections to the peer alive
+    queue: messages waiting to be sent, with the futures of their responses
+    worker: long-lived thread that sends the messages of the queue one at a
+    time, so that the peer receives them in the order they were queued
+    sent: number of sent requests
+    dropped: number of messages that failed because the queue was full
+    total_latency: sum of the latencies of the sent requests
+    last_latency: latency of the last sent request
+    lock: lock in order to provide mutual exclusion while updating the stats
+    """
+
+    def __init__(self, address):
+        """Initializes a Peer and starts its worker"""
+
+        self.address = address
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=PEER_CONNECTIONS))
+        self.queue = Queue(QUEUE_SIZE)
+
+        self.sent = 0
+        self.dropped = 0
+        self.total_latency = 0
+        self.last_latency = 0
+        self.lock = Lock()
+
+        self.worker = Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def send(self, method, endpoint, data=None):
+        """Queues a message to the peer, which is sent after the ones queued
+        before it, and returns the future of its response, which fails at
+        once if the queue is full, so that a slow peer never blocks the
+        messages to the other peers"""
+
+        future = Future()
+        try:
+            self.queue.put_nowait((future, method, endpoint, data))
+        except Full:
+            with self.lock:
+                self.dropped += 1
+            future.set_exception(requests.RequestException('Too many messages queued for ' + self.address))
+        return future
+
+    def request(self, method, endpoint, data=None):
+        """Sends a request to the peer and returns its response"""
+
+        start_time = time.time()
+        response = self.session.request(method, self.address + endpoint, data=data, timeout=TIMEOUT)
+
+        latency = time.time() - start_time
+        with self.lock:
+            self.sent += 1
+            self.total_latency += latency
+            self.last_latency = latency
+        return response
+
+    def work(self):
+        """Sends the queued messages, one at a time"""
+
+        while True:
+            future, method, endpoint, data = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                response = self.request(method, endpoint, data)
+            except requests.RequestException as error:
+                future.set_exception(error)
+                continue
+            future.set_result(response)
+
+    def metrics(self):
+        """Returns the send latencies and the queue depth of the peer"""
+
+        with self.lock:
+            return {
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'average_latency': self.total_latency / self.sent if self.sent else 0,
+                'last_latency': self.last_latency,
+                'queue_depth': self.queue.qsize()
+            }
+
+class Transport:
+    """
+    Class for the transport layer between a node and its peers
+
+    peers: Peer of every known address
+    executor: threads that send the requests that don't wait behind the
+    messages of a peer
+    lock: lock in order to provide mutual exclusion while adding peers
+    """
+
+    def __init__(self):
+        """Initializes a Transport"""
+
+        self.peers = {}
+        self.executor = ThreadPoolExecutor(REQUEST_THREADS)
+        self.lock = Lock()
+
+    def peer(self, ring_node):
+        """Returns the Peer of a node of the ring, connecting to it the first
+        time it is needed"""
+
+        address = ring_node['address']
+        with self.lock:
+            if address not in self.peers:
+                self.peers[address] = Peer(address)
+            return self.peers[address]
+
+    def post(self, ring_node, endpoint, data):
+        """Queues a POST message to a node, after the ones queued before it,
+        and returns the future of its response"""
+
+        return self.peer(ring_node).send('POST', endpoint, data)
+
+    def request(self, ring_node, method, endpoint, data=None):
+        """Sends a request to a node without waiting behind its queued
+        messages and returns the future of its response, for the requests
+        of a sync, which are made while handling a message of another node
+        and would otherwise wait for the messages that it waits for"""
+
+        return self.executor.submit(self.peer(ring_node).request, method, endpoint, data)
+
+    def get(self, ring_node, endpoint):
+        """Sends a GET request to a node without waiting behind its queued
+        messages and returns the future of its response"""
+
+        return self.request(ring_node, 'GET', endpoint)
+
+    def broadcast(self, ring_nodes, endpoint, data):
+        """Queues the same POST message to many nodes and returns the futures
+        of their responses"""
+
+        return [self.post(ring_node, endpoint, data) for ring_node in ring_nodes]
+
+    def metrics(self):
+        """Returns the metrics of every peer by address"""
+
+        with self.lock:
+            peers = list(self.peers.values())
+        return {peer.address: peer.metrics() for peer in peers}
+
+def status_codes(futures):
+    """Waits for the responses of a broadcast and returns their status codes,
+    with None for every request that failed or that the peer was too busy to
+    serve"""
+
+    codes = []
+    for future in futures:
+        try:
+            code = future.result().status_code
+        except requests.RequestException:
+            code = None
+        codes.append(None if code == 503 else code)
+    return codes
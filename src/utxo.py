@@ -0,0 +1,168 @@
+from threading import Lock
+
+class UTXOSet:
+    """
+    Class for the set of the unspent transaction outputs (utxos) of the ring
+
+    outputs: unspent outputs by outpoint, a (transaction id, index) pair
+    owners: outpoints of the unspent outputs of every owner, oldest first
+    balances: sum of the unspent outputs of every owner
+    spent: outputs spent by every unconfirmed transaction, in order to undo it
+    lock: lock in order to provide mutual exclusion while updating the set
+    """
+
+    def __init__(self):
+        """Initializes a UTXOSet"""
+
+        self.outputs = {}
+        self.owners = {}
+        self.balances = {}
+        self.spent = {}
+        self.lock = Lock()
+
+    def __len__(self):
+        """Number of unspent outputs"""
+
+        return len(self.outputs)
+
+    def add_output(self, outpoint, output):
+        """Adds an unspent output"""
+
+        self.outputs[outpoint] = output
+        self.owners.setdefault(output.target, {})[outpoint] = output
+        self.balances[output.target] = self.balances.get(output.target, 0) + output.amount
+
+    def remove_output(self, outpoint):
+        """Removes an output, if it is unspent, and returns it"""
+
+        output = self.outputs.pop(outpoint, None)
+        if output is not None:
+            del self.owners[output.target][outpoint]
+            self.balances[output.target] -= output.amount
+        return output
+
+    def add_transaction(self, transaction):
+        """Spends the inputs of a transaction and adds its outputs"""
+
+        with self.lock:
+            spent = {}
+            for transaction_input in transaction.inputs or []:
+                outpoint = transaction_input.outpoint()
+                output = self.remove_output(outpoint)
+                if output is not None:
+                    spent[outpoint] = output
+            self.spent[transaction.id] = spent
+
+            for index, output in enumerate(transaction.outputs):
+                self.add_output((transaction.id, index), output)
+
+    def undo_transaction(self, transaction):
+        """Removes the outputs of an unconfirmed transaction and adds back the
+        outputs that it spent"""
+
+        with self.lock:
+            for index in range(len(transaction.outputs)):
+                self.remove_output((transaction.id, index))
+            for outpoint, output in self.spent.pop(transaction.id, {}).items():
+                self.add_output(outpoint, output)
+
+    def pending(self, transaction_id):
+        """Checks if a transaction has been added and not yet confirmed"""
+
+        return transaction_id in self.spent
+
+    def added(self, transaction):
+        """Checks if a transaction has been added, which is the case if one
+        of its outputs is unspent"""
+
+        return any((transaction.id, index) in self.outputs for index in range(len(transaction.outputs)))
+
+    def unspent(self, transaction):
+        """Checks if all the outputs of a transaction are unspent"""
+
+        return all((transaction.id, index) in self.outputs for index in range(len(transaction.outputs)))
+
+    def missed(self, transaction):
+        """Checks if a transaction of a block has never been added, which is
+        the case if it isn't pending and the outputs that it spends are still
+        unspent"""
+
+        if transaction.id in self.spent:
+            return False
+        return all(transaction_input.outpoint() in self.outputs for transaction_input in transaction.inputs or [])
+
+    def missing(self, transaction):
+        """Returns the outpoints that a transaction spends and that aren't
+        unspent outputs"""
+
+        return [transaction_input.outpoint() for transaction_input in transaction.inputs or []
+                if transaction_input.outpoint() not in self.outputs]
+
+    def input_total(self, transaction):
+        """Returns the sum of the unspent outputs that a transaction spends,
+        or None if one of them isn't unspent, isn't owned by the sender of
+        the transaction or is spent twice by it, in time proportional to its
+        inputs"""
+
+        outpoints = [transaction_input.outpoint() for transaction_input in transaction.inputs or []]
+        if not outpoints or len(set(outpoints)) != len(outpoints):
+            return None
+
+        total = 0
+        for outpoint in outpoints:
+            output = self.outputs.get(outpoint)
+            if output is None or output.target != transaction.sender:
+                return None
+            total += output.amount
+        return total
+
+    def confirm(self, transactions):
+        """Forgets the spent outputs of confirmed transactions, which can't be
+        undone anymore"""
+
+        with self.lock:
+            for transaction in transactions:
+                self.spent.pop(transaction.id, None)
+
+    def balance(self, owner):
+        """Returns the sum of the unspent outputs of an owner"""
+
+        return self.balances.get(owner, 0)
+
+    def select(self, owner, amount):
+        """Selects and removes the oldest unspent outputs of an owner, until
+        their sum covers the amount, returns them by outpoint or None if the
+        owner doesn't have enough coins"""
+
+        with self.lock:
+            if self.balance(owner) < amount:
+                return None
+
+            selected = {}
+            total = 0
+            for outpoint, output in self.owners.get(owner, {}).items():
+                selected[outpoint] = output
+                total += output.amount
+                if total >= amount:
+                    # Stop when the total amount is enough
+                    break
+
+            for outpoint in selected:
+                self.remove_output(outpoint)
+            return selected
+
+    def clear(self):
+        """Removes every output, before the set is restored from a snapshot"""
+
+        with self.lock:
+            self.outputs.clear()
+            self.owners.clear()
+            self.balances.clear()
+            self.spent.clear()
+
+    def restore(self, selected):
+        """Adds back outputs that were selected for a failed transaction"""
+
+        with self.lock:
+            for outpoint, output in selected.items():
+                self.add_output(outpoint, output)
@@ -1,24 +1,51 @@
-from Crypto.PublicKey import RSA
+import hashlib
+
+from functools import lru_cache
+
+from signature import get_scheme
+
+@lru_cache(maxsize=1024)
+def key_fingerprint(public_key):
+    """Returns the fingerprint of a public key, the first 16 bytes of the
+    SHA-256 of its encoding"""
+
+    return hashlib.sha256(public_key.encode("ISO-8859-1")).digest()[:16]
+
+# Public keys of the ring by fingerprint, so that every key is kept in memory
+# once and messages can refer to a key by its fingerprint
+registered_keys = {}
+
+def register_key(public_key):
+    """Adds a public key to the registry and returns the registered copy of it"""
+
+    return registered_keys.setdefault(key_fingerprint(public_key), public_key)
+
+def find_key(fingerprint):
+    """Returns the registered public key with a fingerprint, or None"""
+
+    return registered_keys.get(fingerprint)
 
 class Wallet:
     """
     Class for a Wallet of a node
 
+    scheme: name of the signature scheme of the keys
     private_key: private key of the node
     public_key: public key of the node, also its address
-    transactions: list that contains the transactions of the wallet
+    transactions: transactions of the wallet by id, except the ones of pruned
+    blocks
+    utxos: set of the unspent transaction outputs of the ring
     """
 
-    def __init__(self):
+    def __init__(self, utxos):
         """Initializes a Wallet"""
 
-        # Generate a private key of key length of 2048 bits
-        key = RSA.generate(2048)
-
-        self.private_key = key.exportKey().decode("ISO-8859-1")
-        # Generate the public key from the above private key
-        self.public_key = key.publickey().exportKey().decode("ISO-8859-1")
-        self.transactions = []
+        # Generate the key pair with the signature scheme of the ring
+        scheme = get_scheme()
+        self.scheme = scheme.name
+        self.private_key, self.public_key = scheme.generate()
+        self.transactions = {}
+        self.utxos = utxos
 
     def __str__(self):
         """String representation of a Wallet"""
@@ -29,11 +56,5 @@ class Wallet:
         """Calculates balance of the wallet based on the utxos"""
 
         # Balance of the wallet equals the sum of the UTXOs with
-        # the wallet as recipient
-        balance = 0
-        for transaction in self.transactions:
-            for output in transaction.outputs:
-                if output.unspent and output.target == self.public_key:
-                    balance += output.amount
-
-        return balance
+        # the wallet as recipient, kept up to date by the utxo set
+        return self.utxos.balance(self.public_key)
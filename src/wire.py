@@ -0,0 +1,607 @@
+import struct
+
+from ring import Ring
+from block import Block, Blockchain
+from snapshot import Snapshot
+from transaction import Transaction, TransactionInput, TransactionOutput
+from wallet import key_fingerprint, find_key
+
+# Version of the wire format, checked on every received message
+VERSION = 5
+
+# Kinds of messages
+TRANSACTION = 1
+TRANSACTIONS = 2
+BLOCK = 3
+CHAIN = 4
+RING = 5
+BLOCKS = 6
+SNAPSHOT = 7
+HEADERS = 8
+
+# Fixed size fields
+MESSAGE_HEADER = struct.Struct('>BB')
+LENGTH = struct.Struct('>I')
+INTEGER = struct.Struct('>q')
+FLOAT = struct.Struct('>d')
+BYTE = struct.Struct('>B')
+DIGEST = struct.Struct('>32s')
+FINGERPRINT = struct.Struct('>16s')
+
+# Fixed size fields of a Transaction: sender id, receiver id, amount, total,
+# id and the number of its inputs and of its outputs, read at once
+TRANSACTION_FIELDS = struct.Struct('>qqqq32sII')
+
+# Spent transaction id and index of a TransactionInput
+INPUT_FIELDS = struct.Struct('>32sI')
+
+# Target tag and amount of a TransactionOutput
+OUTPUT_FIELDS = struct.Struct('>Bq')
+
+# Fixed size fields of a mined Block: index, timestamp and nonce
+BLOCK_FIELDS = struct.Struct('>qdQ')
+
+# Tags of a hash field, which can also be missing or the 1 of the genesis block
+HASH_NONE = 0
+HASH_INTEGER = 1
+HASH_HEX = 2
+
+# Tags of the target of a TransactionOutput, which is almost always the
+# receiver or the sender of its transaction and doesn't need to be repeated
+TARGET_RECEIVER = 0
+TARGET_SENDER = 1
+TARGET_OTHER = 2
+
+# Tags of the body of a Block, which is either its transactions or, if it is
+# pruned, the root of their Merkle tree
+BODY_PRUNED = 0
+BODY_FULL = 1
+
+# Tags of a public key, which is written in full only if it isn't in the key
+# registry of the ring, the next tags are positions of already written keys
+KEY_FULL = 0
+KEY_FINGERPRINT = 1
+KEY_POSITIONS = 2
+
+class Encoder:
+    """
+    Class that builds a binary message field by field
+
+    parts: encoded fields of the message
+    keys: position of every public key that has already been written, so
+    that each key is written only once per message, and by its fingerprint
+    if it is registered
+    """
+
+    def __init__(self, kind):
+        """Initializes an Encoder with the header of a message"""
+
+        self.parts = [MESSAGE_HEADER.pack(VERSION, kind)]
+        self.keys = {}
+
+    def message(self):
+        """Returns the encoded message"""
+
+        return b''.join(self.parts)
+
+    def fields(self, fmt, *values):
+        """Writes several fixed size fields at once"""
+
+        self.parts.append(fmt.pack(*values))
+
+    def byte(self, value):
+        """Writes a single byte"""
+
+        self.parts.append(BYTE.pack(value))
+
+    def length(self, value):
+        """Writes a length or a count"""
+
+        self.parts.append(LENGTH.pack(value))
+
+    def integer(self, value):
+        """Writes a signed integer"""
+
+        self.parts.append(INTEGER.pack(value))
+
+    def float(self, value):
+        """Writes a float"""
+
+        self.parts.append(FLOAT.pack(value))
+
+    def bytes(self, value):
+        """Writes a byte string, prefixed by its length"""
+
+        self.parts.append(LENGTH.pack(len(value)))
+        self.parts.append(value)
+
+    def digest(self, value):
+        """Writes a 32 byte id"""
+
+        self.parts.append(DIGEST.pack(value))
+
+    def string(self, value):
+        """Writes a latin-1 string"""
+
+        self.bytes(value.encode("ISO-8859-1"))
+
+    def optional_string(self, value):
+        """Writes a string that can be None"""
+
+        if value is None:
+            self.byte(0)
+        else:
+            self.byte(1)
+            self.string(value)
+
+    def key(self, value):
+        """Writes a public key, by its fingerprint if it is registered, or its
+        position if it was already written"""
+
+        position = self.keys.get(value)
+        if position is not None:
+            self.length(position)
+            return
+
+        fingerprint = key_fingerprint(value)
+        if find_key(fingerprint) is not None:
+            self.length(KEY_FINGERPRINT)
+            self.parts.append(FINGERPRINT.pack(fingerprint))
+        else:
+            self.length(KEY_FULL)
+            self.string(value)
+        self.keys[value] = len(self.keys) + KEY_POSITIONS
+
+    def optional_integer(self, value):
+        """Writes an integer that can be None"""
+
+        if value is None:
+            self.byte(0)
+        else:
+            self.byte(1)
+            self.integer(value)
+
+    def hash(self, value):
+        """Writes a hex hash, that can also be None or an integer"""
+
+        if value is None:
+            self.byte(HASH_NONE)
+        elif isinstance(value, int):
+            self.byte(HASH_INTEGER)
+            self.integer(value)
+        else:
+            self.byte(HASH_HEX)
+            self.bytes(bytes.fromhex(value))
+
+class Decoder:
+    """
+    Class that reads a binary message field by field
+
+    data: the message
+    offset: position of the next field
+    keys: public keys that have already been read
+    """
+
+    def __init__(self, data, kind):
+        """Initializes a Decoder and checks the header of the message"""
+
+        self.data = memoryview(data)
+        self.offset = 0
+        self.keys = []
+        version, message_kind = self.unpack(MESSAGE_HEADER)
+        if version != VERSION:
+            raise ValueError('Unsupported wire format version %d' % version)
+        if message_kind != kind:
+            raise ValueError('Unexpected message kind %d' % message_kind)
+
+    def unpack(self, fmt):
+        """Reads a fixed size field"""
+
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def records(self, fmt, count):
+        """Reads consecutive fixed size records at once"""
+
+        start = self.offset
+        self.offset += count * fmt.size
+        if self.offset > len(self.data):
+            raise ValueError('Records exceed the message')
+        return fmt.iter_unpack(self.data[start:self.offset])
+
+    def end(self):
+        """Checks that the whole message has been read"""
+
+        if self.offset != len(self.data):
+            raise ValueError('Trailing data after the message')
+
+    def byte(self):
+        """Reads a single byte"""
+
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def length(self):
+        """Reads a length or a count"""
+
+        value = LENGTH.unpack_from(self.data, self.offset)[0]
+        self.offset += LENGTH.size
+        return value
+
+    def integer(self):
+        """Reads a signed integer"""
+
+        return self.unpack(INTEGER)[0]
+
+    def float(self):
+        """Reads a float"""
+
+        return self.unpack(FLOAT)[0]
+
+    def bytes(self):
+        """Reads a byte string, prefixed by its length"""
+
+        return bytes(self.field())
+
+    def field(self):
+        """Returns a view of a byte string, prefixed by its length, without
+        copying it"""
+
+        start = self.offset + LENGTH.size
+        self.offset = start + LENGTH.unpack_from(self.data, self.offset)[0]
+        if self.offset > len(self.data):
+            raise ValueError('Field exceeds the message')
+        return self.data[start:self.offset]
+
+    def digest(self):
+        """Reads a 32 byte id"""
+
+        return self.unpack(DIGEST)[0]
+
+    def string(self):
+        """Reads a latin-1 string"""
+
+        return str(self.field(), "ISO-8859-1")
+
+    def optional_string(self):
+        """Reads a string that can be None"""
+
+        self.offset += 1
+        return str(self.field(), "ISO-8859-1") if self.data[self.offset - 1] else None
+
+    def key(self):
+        """Reads a public key, its fingerprint or the position of one that was
+        already read, returning the registered copy of the key if there is one"""
+
+        position = LENGTH.unpack_from(self.data, self.offset)[0]
+        self.offset += LENGTH.size
+        if position >= KEY_POSITIONS:
+            return self.keys[position - KEY_POSITIONS]
+
+        if position == KEY_FINGERPRINT:
+            value = find_key(FINGERPRINT.unpack_from(self.data, self.offset)[0])
+            self.offset += FINGERPRINT.size
+            if value is None:
+                raise ValueError('Unknown public key')
+        else:
+            value = self.string()
+            value = find_key(key_fingerprint(value)) or value
+        self.keys.append(value)
+        return value
+
+    def optional_integer(self):
+        """Reads an integer that can be None"""
+
+        return self.integer() if self.byte() else None
+
+    def hash(self):
+        """Reads a hex hash, that can also be None or an integer"""
+
+        tag = self.byte()
+        if tag == HASH_NONE:
+            return None
+        if tag == HASH_INTEGER:
+            return self.integer()
+        if tag == HASH_HEX:
+            return self.bytes().hex()
+        raise ValueError('Unknown hash tag %d' % tag)
+
+def decoding(function):
+    """Turns every error of a decoding function on malformed data into a
+    ValueError, that the endpoints answer with a 400"""
+
+    def wrapper(data, *args):
+        try:
+            return function(data, *args)
+        except (struct.error, IndexError, KeyError, TypeError) as error:
+            raise ValueError('Malformed message: %s' % error)
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+def write_transaction(encoder, transaction):
+    """Writes the fields of a Transaction"""
+
+    inputs = transaction.inputs or []
+    encoder.fields(TRANSACTION_FIELDS, int(transaction.sender_id), int(transaction.receiver_id),
+                   transaction.amount, transaction.total, transaction.id, len(inputs), len(transaction.outputs))
+    encoder.key(transaction.sender)
+    encoder.key(transaction.receiver)
+    encoder.optional_string(transaction.signature)
+
+    for transaction_input in inputs:
+        encoder.fields(INPUT_FIELDS, transaction_input.output_id, transaction_input.index)
+
+    # The outputs are consecutive records, followed by the targets that
+    # aren't the receiver or the sender
+    other_targets = []
+    for output in transaction.outputs:
+        if output.target == transaction.receiver:
+            encoder.fields(OUTPUT_FIELDS, TARGET_RECEIVER, output.amount)
+        elif output.target == transaction.sender:
+            encoder.fields(OUTPUT_FIELDS, TARGET_SENDER, output.amount)
+        else:
+            encoder.fields(OUTPUT_FIELDS, TARGET_OTHER, output.amount)
+            other_targets.append(output.target)
+    for target in other_targets:
+        encoder.key(target)
+
+def read_transaction(decoder):
+    """Reads the fields of a Transaction, its fixed size records straight
+    from the data of the decoder"""
+
+    data = decoder.data
+    (sender_id, receiver_id, amount, total, id,
+     input_count, output_count) = TRANSACTION_FIELDS.unpack_from(data, decoder.offset)
+    decoder.offset += TRANSACTION_FIELDS.size
+    sender = decoder.key()
+    receiver = decoder.key()
+    signature = decoder.optional_string()
+
+    inputs = tuple([TransactionInput(output_id, index)
+                    for output_id, index in decoder.records(INPUT_FIELDS, input_count)])
+
+    # The records are sliced before the other targets are read after them,
+    # and the tags of the receiver and the sender index their targets
+    targets = (receiver, sender)
+    outputs = tuple([TransactionOutput(id, targets[tag] if tag < TARGET_OTHER else decoder.key(), output_amount)
+                     for tag, output_amount in decoder.records(OUTPUT_FIELDS, output_count)])
+
+    return Transaction.received(sender, sender_id, receiver, receiver_id, amount, total,
+                                inputs, id, outputs, signature)
+
+def write_block(encoder, block, body=True):
+    """Writes the fields of a Block, or only its header, with the root of the
+    Merkle tree of its transactions instead of them"""
+
+    encoder.fields(BLOCK_FIELDS, block.index, block.timestamp, block.nonce)
+    encoder.hash(block.previous_hash)
+    encoder.hash(block.hash)
+
+    if not body or block.transactions is None:
+        encoder.byte(BODY_PRUNED)
+        encoder.digest(block.root())
+        return
+
+    encoder.byte(BODY_FULL)
+    encoder.length(len(block.transactions))
+    for transaction in block.transactions:
+        write_transaction(encoder, transaction)
+
+def valid_hash(value):
+    """Checks if a decoded hash is the hex of a 32 byte hash"""
+
+    return isinstance(value, str) and len(value) == 2 * DIGEST.size
+
+def read_block(decoder, merkle_root=None):
+    """Reads the fields of a Block, or only its header if the root of the
+    Merkle tree of its transactions is given"""
+
+    index, timestamp, nonce = decoder.unpack(BLOCK_FIELDS)
+    previous_hash = decoder.hash()
+    block_hash = decoder.hash()
+    if not valid_hash(block_hash) or not (previous_hash == 1 or valid_hash(previous_hash)):
+        # The header of the block is hashed with its previous hash, which is
+        # 1 for the genesis block
+        raise ValueError('Malformed block hashes')
+    if decoder.byte() == BODY_PRUNED:
+        # The hash of a pruned block is validated with the received root
+        return Block.received(index, timestamp, nonce, previous_hash, block_hash, None, decoder.digest())
+    if merkle_root is not None:
+        # The transactions are skipped, the block is read as a pruned one
+        return Block.received(index, timestamp, nonce, previous_hash, block_hash, None, merkle_root)
+
+    transactions = [read_transaction(decoder) for _ in range(decoder.length())]
+    return Block.received(index, timestamp, nonce, previous_hash, block_hash, transactions)
+
+def encode_transaction(transaction):
+    """Encodes a Transaction"""
+
+    encoder = Encoder(TRANSACTION)
+    write_transaction(encoder, transaction)
+    return encoder.message()
+
+@decoding
+def decode_transaction(data):
+    """Decodes a Transaction"""
+
+    decoder = Decoder(data, TRANSACTION)
+    transaction = read_transaction(decoder)
+    decoder.end()
+    return transaction
+
+def encode_transactions(transactions):
+    """Encodes a list of transactions"""
+
+    encoder = Encoder(TRANSACTIONS)
+    encoder.length(len(transactions))
+    for transaction in transactions:
+        write_transaction(encoder, transaction)
+    return encoder.message()
+
+@decoding
+def decode_transactions(data):
+    """Decodes a list of transactions"""
+
+    decoder = Decoder(data, TRANSACTIONS)
+    transactions = [read_transaction(decoder) for _ in range(decoder.length())]
+    decoder.end()
+    return transactions
+
+def encode_block(block):
+    """Encodes a Block"""
+
+    encoder = Encoder(BLOCK)
+    write_block(encoder, block)
+    return encoder.message()
+
+@decoding
+def decode_block(data):
+    """Decodes a Block"""
+
+    decoder = Decoder(data, BLOCK)
+    block = read_block(decoder)
+    decoder.end()
+    return block
+
+@decoding
+def decode_block_header(data, merkle_root):
+    """Decodes only the header of a Block, as a pruned block with the root of
+    the Merkle tree of its transactions, which the encoding doesn't include"""
+
+    return read_block(Decoder(data, BLOCK), merkle_root)
+
+def encode_chain(chain):
+    """Encodes a Blockchain"""
+
+    encoder = Encoder(CHAIN)
+    encoder.length(len(chain.blocks))
+    for block in chain.blocks:
+        write_block(encoder, block)
+    return encoder.message()
+
+@decoding
+def decode_chain(data):
+    """Decodes a Blockchain"""
+
+    decoder = Decoder(data, CHAIN)
+    chain = Blockchain()
+    chain.load(read_block(decoder) for _ in range(decoder.length()))
+    decoder.end()
+    return chain
+
+def encode_blocks(start, blocks):
+    """Encodes a range of consecutive blocks of a chain, starting at a height"""
+
+    encoder = Encoder(BLOCKS)
+    encoder.length(start)
+    encoder.length(len(blocks))
+    for block in blocks:
+        write_block(encoder, block)
+    return encoder.message()
+
+@decoding
+def decode_blocks(data):
+    """Decodes a range of blocks, returns its starting height and the blocks"""
+
+    decoder = Decoder(data, BLOCKS)
+    start = decoder.length()
+    blocks = [read_block(decoder) for _ in range(decoder.length())]
+    decoder.end()
+    return start, blocks
+
+def encode_headers(start, blocks):
+    """Encodes the headers of a range of consecutive blocks of a chain,
+    starting at a height"""
+
+    encoder = Encoder(HEADERS)
+    encoder.length(start)
+    encoder.length(len(blocks))
+    for block in blocks:
+        write_block(encoder, block, body=False)
+    return encoder.message()
+
+@decoding
+def decode_headers(data):
+    """Decodes the headers of a range of blocks, returns its starting height
+    and the headers, as pruned blocks"""
+
+    decoder = Decoder(data, HEADERS)
+    start = decoder.length()
+    headers = [read_block(decoder) for _ in range(decoder.length())]
+    decoder.end()
+    return start, headers
+
+def encode_ring(ring):
+    """Encodes a Ring"""
+
+    encoder = Encoder(RING)
+    encoder.string(ring.scheme)
+    encoder.length(len(ring))
+    for ring_node in ring:
+        encoder.integer(ring_node['id'])
+        encoder.string(ring_node['ip'])
+        encoder.string(str(ring_node['port']))
+        encoder.string(ring_node['public_key'])
+        encoder.integer(ring_node['balance'])
+    return encoder.message()
+
+@decoding
+def decode_ring(data):
+    """Decodes a Ring"""
+
+    decoder = Decoder(data, RING)
+    ring = Ring()
+    ring.scheme = decoder.string()
+    for _ in range(decoder.length()):
+        ring.register(decoder.integer(), decoder.string(), decoder.string(),
+                      decoder.string(), decoder.integer())
+    decoder.end()
+    return ring
+
+def encode_snapshot(snapshot):
+    """Encodes a Snapshot, with its outputs and balances sorted so that the
+    encoding of a state is always the same"""
+
+    encoder = Encoder(SNAPSHOT)
+    encoder.length(snapshot.height)
+    encoder.hash(snapshot.block_hash)
+
+    outputs = sorted(snapshot.utxos.outputs.items(), key=lambda item: item[0])
+    encoder.length(len(outputs))
+    for (transaction_id, index), output in outputs:
+        encoder.digest(transaction_id)
+        encoder.length(index)
+        encoder.key(output.target)
+        encoder.integer(output.amount)
+
+    balances = sorted(snapshot.balances.items())
+    encoder.length(len(balances))
+    for public_key, balance in balances:
+        encoder.key(public_key)
+        encoder.integer(balance)
+    return encoder.message()
+
+@decoding
+def decode_snapshot(data):
+    """Decodes a Snapshot"""
+
+    decoder = Decoder(data, SNAPSHOT)
+    snapshot = Snapshot(decoder.length(), decoder.hash())
+
+    for _ in range(decoder.length()):
+        transaction_id = decoder.digest()
+        index = decoder.length()
+        target = decoder.key()
+        snapshot.utxos.add_output((transaction_id, index),
+                                  TransactionOutput(transaction_id, target, decoder.integer()))
+
+    for _ in range(decoder.length()):
+        public_key = decoder.key()
+        snapshot.balances[public_key] = decoder.integer()
+
+    decoder.end()
+    return snapshot
@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import tracemalloc
+
+from argparse import ArgumentParser
+
+# Add the source files in our path.
+sys.path.insert(0, '../src')
+import signature
+
+from ring import Ring
+from utxo import UTXOSet
+from wallet import Wallet
+from block import Block, Blockchain
+from transaction import Transaction, TransactionInput
+
+def create_transactions(wallets, count, signature_size):
+    """Creates a sequence of transactions between the given wallets, each one
+    spending the change of the previous one, with random signatures of the
+    size of the scheme, since signing a million transactions takes too long"""
+
+    transactions = []
+    previous_id = bytes(32)
+    for i in range(count):
+        sender = wallets[i % len(wallets)]
+        receiver = wallets[(i + 1) % len(wallets)]
+        transaction = Transaction(
+            sender.public_key, i % len(wallets),
+            receiver.public_key, (i + 1) % len(wallets),
+            10, 25, [TransactionInput(previous_id, 1)])
+        transaction.signature = os.urandom(signature_size).decode("ISO-8859-1")
+        transactions.append(transaction.seal())
+        previous_id = transaction.id
+    return transactions
+
+def create_chain(transactions, capacity):
+    """Creates a chain of sealed blocks that contain the given transactions"""
+
+    chain = Blockchain()
+    previous_hash = 1
+    for index, start in enumerate(range(0, len(transactions), capacity)):
+        block = Block(index, previous_hash)
+        block.transactions = transactions[start:start + capacity]
+        block.nonce = 0
+        block.hash = block.hash_block()
+        chain.blocks.append(block.seal())
+        previous_hash = block.hash
+    return chain
+
+def traced():
+    """Returns the size of the memory that is currently allocated"""
+
+    return tracemalloc.get_traced_memory()[0]
+
+if __name__ == "__main__":
+    # Define the argument parser.
+    parser = ArgumentParser(description='Measures the memory that a noobcash node needs for its chain.')
+
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-t', type=int, default=1000000, help='number of transactions in the chain')
+    optional.add_argument('-c', type=int, default=5, help='capacity of a block')
+    optional.add_argument('-n', type=int, default=5, help='number of nodes in the ring')
+    optional.add_argument('-k', type=int, help='prune all the blocks except for the latest k ones')
+    optional.add_argument('-s', choices=signature.SCHEMES, default=signature.DEFAULT_SCHEME, help='signature scheme')
+
+    # Parse the given arguments.
+    args = parser.parse_args()
+    signature.set_scheme(args.s)
+
+    # The keys are registered once in the ring and shared by all transactions
+    wallets = [Wallet(UTXOSet()) for _ in range(args.n)]
+    ring = Ring()
+    for i, wallet in enumerate(wallets):
+        ring.register(i, '192.168.2.%d' % (i + 1), '5000', wallet.public_key, 100)
+
+    sample = Transaction(wallets[0].public_key, 0, wallets[1].public_key, 1, 10, 25, [])
+    sample.sign_transaction(wallets[0].private_key)
+    signature_size = len(sample.signature)
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+
+    start = traced()
+    transactions = create_transactions(wallets, args.t, signature_size)
+    transactions_size = traced() - start
+
+    start = traced()
+    chain = create_chain(transactions, args.c)
+    blocks_size = traced() - start
+
+    # The transactions are only referenced by the blocks from now on
+    del transactions
+    total_size = traced()
+
+    if args.k is not None:
+        chain.prune(len(chain.blocks) - args.k)
+        pruned_size = traced()
+    elapsed = time.perf_counter() - start_time
+    tracemalloc.stop()
+
+    blocks = len(chain.blocks)
+    print('transactions: %d, blocks: %d, capacity: %d, scheme: %s, built in %.1f s' % (
+        args.t, blocks, args.c, args.s, elapsed))
+    print('per transaction: %8.1f bytes (%d bytes of signature)' % (transactions_size / args.t, signature_size))
+    print('per block:       %8.1f bytes without its transactions, %.1f bytes with them' % (
+        blocks_size / blocks, (transactions_size + blocks_size) / blocks))
+    print('total:           %8.1f MB' % (total_size / 1e6))
+    if args.k is not None:
+        print('pruned to %d:    %8.1f MB, %.1f bytes per block' % (
+            args.k, pruned_size / 1e6, pruned_size / blocks))
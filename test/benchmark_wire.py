@@ -0,0 +1,88 @@
+import sys
+import time
+import pickle
+
+from argparse import ArgumentParser
+
+# Add the source files in our path.
+sys.path.insert(0, '../src')
+import wire
+import signature
+
+from utxo import UTXOSet
+from wallet import Wallet
+from block import Block, Blockchain
+from transaction import Transaction, TransactionInput
+
+def create_block(wallets, capacity, index, previous_hash):
+    """Creates a block with signed transactions between the given wallets"""
+
+    block = Block(index, previous_hash)
+    for i in range(capacity):
+        sender = wallets[i % len(wallets)]
+        receiver = wallets[(i + 1) % len(wallets)]
+        transaction = Transaction(
+            sender.public_key, i % len(wallets),
+            receiver.public_key, (i + 1) % len(wallets),
+            10, 25, [TransactionInput(i.to_bytes(32, 'big'), 0)])
+        transaction.sign_transaction(sender.private_key)
+        block.transactions.append(transaction)
+
+    block.nonce = 0
+    block.hash = block.hash_block()
+    return block
+
+def measure(function, argument, rounds):
+    """Returns the average time of a function call in microseconds"""
+
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        function(argument)
+    return (time.perf_counter() - start_time) / rounds * 1e6
+
+def report(name, value, encode, decode, rounds):
+    """Prints the size and the encode and decode times of pickle and of the
+    wire format for a value"""
+
+    pickled = pickle.dumps(value)
+    encoded = encode(value)
+    print('%-12s pickle: %8d bytes %9.1f us enc %9.1f us dec' % (
+        name, len(pickled), measure(pickle.dumps, value, rounds), measure(pickle.loads, pickled, rounds)))
+    print('%-12s wire:   %8d bytes %9.1f us enc %9.1f us dec (%.1fx smaller)' % (
+        '', len(encoded), measure(encode, value, rounds), measure(decode, encoded, rounds),
+        len(pickled) / len(encoded)))
+
+if __name__ == "__main__":
+    # Define the argument parser.
+    parser = ArgumentParser(description='Compares pickle with the wire format of noobcash.')
+
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-c', type=int, default=5, help='capacity of a block')
+    optional.add_argument('-l', type=int, default=20, help='length of the chain')
+    optional.add_argument('-n', type=int, default=5, help='number of nodes in the ring')
+    optional.add_argument('-s', choices=signature.SCHEMES, default=signature.DEFAULT_SCHEME, help='signature scheme')
+    optional.add_argument('-r', type=int, default=200, help='rounds of every measurement')
+
+    # Parse the given arguments.
+    args = parser.parse_args()
+    signature.set_scheme(args.s)
+
+    wallets = [Wallet(UTXOSet()) for _ in range(args.n)]
+
+    chain = Blockchain()
+    previous_hash = 1
+    for index in range(args.l):
+        block = create_block(wallets, args.c, index, previous_hash)
+        chain.blocks.append(block)
+        previous_hash = block.hash
+
+    ring = wire.Ring()
+    ring.scheme = args.s
+    for i, wallet in enumerate(wallets):
+        ring.register(i, '192.168.2.%d' % (i + 1), '5000', wallet.public_key, 100)
+
+    transaction = chain.blocks[0].transactions[0]
+    report('transaction', transaction, wire.encode_transaction, wire.decode_transaction, args.r)
+    report('block', chain.blocks[0], wire.encode_block, wire.decode_block, args.r)
+    report('chain', chain, wire.encode_chain, wire.decode_chain, max(args.r // args.l, 1))
+    report('ring', ring, wire.encode_ring, wire.decode_ring, args.r)
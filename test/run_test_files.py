@@ -37,14 +37,12 @@ else:
 
 total_time = 0
 num_transactions = 0
-total_mining_time = 0
 
 def start_transactions():
     """This function sends the transactions of the text file"""
 
     global total_time
     global num_transactions
-    global total_mining_time
     address = 'http://' + IPAddr + ':' + str(port) + '/api/create_transaction'
     with open(input_file, 'r') as f:
         for line in f:
@@ -62,11 +60,9 @@ def start_transactions():
                 response = requests.post(address, data=transaction)
                 end_time = time.time() - start_time
                 message = response.json()["message"]
-                mining_time = response.json()["mining_time"]
                 if response.status_code == 200:
                     total_time += end_time
                     num_transactions += 1
-                    total_mining_time += mining_time
                 print(message + "\n")
             except:
                 exit("Node is not active. Try again later.\n")
@@ -81,7 +77,7 @@ def start_transactions():
         difficulty = response['difficulty']
         node_id = int(id)
         throughput = num_transactions/total_time
-        block_time = total_mining_time/num_blocks
+        block_time = response['mining']['mining_time']/num_blocks
 
         # with open('./results/5node' + str(node_id) + '.txt', 'a') as f:
         with open('./results/10node' + str(node_id) + '.txt', 'a') as f: